@@ -0,0 +1,132 @@
+import numpy as np
+import scipy.fft
+
+l2n = lambda l: np.array(l)
+n2l = lambda n: list(n)
+
+
+# Normals in a cone of half angle cone [deg] around axis, on rings every step [deg] (azimuth spacing ~ step as well)
+def orientation_lattice(axis, cone, step):
+
+    axis = l2n(axis).astype(float)
+    axis = axis / np.linalg.norm(axis)
+
+    helper = l2n([1.0, 0, 0]) if abs(axis[0]) < 0.9 else l2n([0, 1.0, 0])
+    b1 = np.cross(axis, helper)
+    b1 = b1 / np.linalg.norm(b1)
+    b2 = np.cross(axis, b1)
+
+    normals = [axis]
+    for tilt in np.deg2rad(np.arange(step, cone + 1e-9, step)):
+        count = max(int(np.round(2 * np.pi * np.sin(tilt) / np.deg2rad(step))), 1)
+        for azimuth in 2 * np.pi * np.arange(count) / count:
+            normals.append(np.cos(tilt) * axis + np.sin(tilt) * (np.cos(azimuth) * b1 + np.sin(azimuth) * b2))
+
+    return l2n(normals)
+
+
+class fftPlacementEngine():
+    """Exhaustive placement scoring by FFT correlation, one orientation at a time.
+
+    For a fixed normal the sum of the complex field over the cap centred at every voxel is the correlation of the field
+    with the cap template, so one FFT product scores all centres at once. Placements are rejected exactly like
+    ``score_template_context`` does: a second correlation counts cap voxels that are bone, outside the ROI (field == 0) or
+    outside the grid (the zero padding is marked infeasible), and the normal has to be within ``normal_angle`` of the
+    direction to the target. Templates come from the shared ``capTemplateCache``, so scores match the optimizer's.
+    """
+
+    def __init__(self, FIELD, skullCrop_arr, target_idx, capCache, normal_angle=20, workers=None):
+
+        self.FIELD = FIELD
+        self.skullCrop_arr = skullCrop_arr
+        self.target_idx = l2n(target_idx).astype(float)
+        self.capCache = capCache
+        self.normal_angle = normal_angle
+        self.workers = workers
+
+        self.shape = l2n(skullCrop_arr.shape)
+
+    def prepare(self, templates):
+        """Pad the grid by the largest template reach and transform field and infeasibility mask once."""
+
+        reach = max(int(np.abs(offsets).max()) for offsets in templates)
+        self.pad = reach
+        self.fft_shape = tuple(scipy.fft.next_fast_len(int(n) + 2 * reach) for n in self.shape)
+        inner = tuple(slice(reach, reach + n) for n in self.shape)
+
+        bad = np.ones(self.fft_shape, dtype=np.float32)
+        bad[inner] = (self.skullCrop_arr > 250) | np.any(self.FIELD == 0, axis=0)
+        self.bad_hat = scipy.fft.rfftn(bad, workers=self.workers)
+        del bad
+
+        self.field_hat = []
+        field = np.zeros(self.fft_shape, dtype=np.complex64)
+        for i in range(self.FIELD.shape[0]):
+            field[inner] = self.FIELD[i]
+            self.field_hat.append(scipy.fft.fftn(field, workers=self.workers))
+        del field
+
+        # Unit direction from every centre (x, y, z index = reversed array index) to the target
+        grid = np.indices(self.shape, dtype=np.float32)
+        direction = self.target_idx[::-1, None, None, None].astype(np.float32) - grid
+        direction /= np.maximum(np.linalg.norm(direction, axis=0), 1e-6)
+        self.direction = direction
+
+    def kernel(self, offsets):
+
+        kernel = np.zeros(self.fft_shape, dtype=np.float32)
+        index = tuple(np.mod(offsets[:, a], self.fft_shape[a]) for a in range(3))
+        kernel[index] = 1
+
+        return kernel
+
+    def score_orientation(self, offsets, Tnormal):
+        """Score map (array order) of every centre for one template."""
+
+        inner = tuple(slice(self.pad, self.pad + n) for n in self.shape)
+        kernel = self.kernel(offsets)
+
+        # Correlation: ifft(F * conj(K)) for a real kernel K
+        count = scipy.fft.irfftn(self.bad_hat * np.conj(scipy.fft.rfftn(kernel, workers=self.workers)),
+                                 s=self.fft_shape, workers=self.workers)[inner]
+        kernel_hat = np.conj(scipy.fft.fftn(kernel, workers=self.workers))
+        del kernel
+
+        score = np.zeros(tuple(self.shape), dtype=np.float32)
+        for field_hat in self.field_hat:
+            score += np.abs(scipy.fft.ifftn(field_hat * kernel_hat, workers=self.workers)[inner])
+
+        # Normal (x, y, z) against the array-order direction field
+        cos_angle = Tnormal[2] * self.direction[0] + Tnormal[1] * self.direction[1] + Tnormal[0] * self.direction[2]
+        valid = (count < 0.5) & (cos_angle >= np.cos(np.deg2rad(self.normal_angle)))
+
+        return np.where(valid, score, 0)
+
+    def run(self, normals):
+        """Best score and the index of the best orientation for every centre.
+
+        :return: Tuple of (best, best_index, normals) where normals are the quantised normals actually scored.
+        """
+
+        keys = list(dict.fromkeys(self.capCache.keys(l2n(normals).astype(float))))
+        normals = l2n([self.capCache.quantised_normal(key) for key in keys])
+        templates = [self.capCache.lookup_key(key) for key in keys]
+
+        self.prepare(templates)
+
+        best = np.zeros(tuple(self.shape), dtype=np.float32)
+        best_index = np.full(tuple(self.shape), -1, dtype=np.int16)
+        for i, (offsets, Tnormal) in enumerate(zip(templates, normals)):
+            score = self.score_orientation(offsets, Tnormal)
+
+            better = score > best
+            best[better] = score[better]
+            best_index[better] = i
+
+        return best, best_index, normals
+
+    def release(self):
+
+        self.bad_hat = None
+        self.field_hat = None
+        self.direction = None
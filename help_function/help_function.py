@@ -1,82 +1,404 @@
 import numpy as np
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import SimpleITK as sitk
 import scipy.io as sio
 from tqdm import tqdm
 from numba import jit
-from numba import njit, prange, cuda
+from numba import njit, prange, cuda, types
 
 l2n = lambda l: np.array(l)
 n2l = lambda n: list(n)
 
-
-@jit(nopython=True, parallel=True, fastmath= True)
-def make_ROI_fast(ROI_idx, p_raw, times, BP_Phase, BP_Amp, BP_step,period):
-    for i in range(ROI_idx.shape[0]):
-        record = p_raw[ROI_idx[i, 0], ROI_idx[i, 1], ROI_idx[i, 2], :]
-        peaks = np.argmax(record)
-        TOF = times[peaks]
-        Amp = record[peaks]
-        BP_Phase[ROI_idx[i, 0], ROI_idx[i, 1], ROI_idx[i, 2]] = 2 * np.pi * ((TOF / period) - np.floor(TOF / period))
-        BP_Amp[ROI_idx[i, 0], ROI_idx[i, 1], ROI_idx[i, 2]] = Amp
-        BP_step[ROI_idx[i, 0], ROI_idx[i, 1], ROI_idx[i, 2]] = np.floor(TOF / period)
-
-    return BP_Phase, BP_Amp, BP_step
-
-@jit(nopython=True, parallel=True, fastmath= True)
-def make_transducer(ROC, width, dx, Tcenter, Tnormal):
+####################################################################
+# Signatures of the hot kernels: they are compiled when the module is imported and cached on disk (cache=True), so a
+# fresh worker process loads machine code instead of compiling. Inputs that are only read are typed read-only, which
+# also accepts writable arrays and the memmaps shared with pool workers.
+def array_type(dtype, ndim, readonly=False):
+    return types.Array(dtype, ndim, 'A', readonly=readonly)
+
+f8_3d = array_type(types.float64, 3)
+
+make_ROI_chunk_sig = [types.void(array_type(types.int64, 2, True), array_type(dtype, 2, True),
+                                 array_type(types.float64, 1, True), f8_3d, f8_3d, f8_3d, types.float64)
+                      for dtype in (types.float32, types.float64)]
+make_field_sig = [array_type(types.complex64, 3)(array_type(types.float64, 3, True), array_type(types.float64, 3, True),
+                                                 array_type(types.complex64, 3))]
+make_cap_offsets_sig = [types.int64[:, ::1](types.float64, types.float64, types.float64,
+                                            array_type(types.float64, 1, True))]
+# Everything a placement score needs, built once per case (make_scoring_context). Its arrays are frozen (read-only,
+# C-contiguous) so owned arrays and shared memmaps have the same numba type.
+ScoringContext = namedtuple('ScoringContext', ['ROI_range', 'shape', 'blocked', 'target_idx', 'FIELD'])
+
+def frozen_type(dtype, ndim):
+    return types.Array(dtype, ndim, 'C', readonly=True)
+
+scoring_context_type = types.NamedTuple((frozen_type(types.int64, 2), frozen_type(types.int64, 1),
+                                         frozen_type(types.uint8, 1), frozen_type(types.int64, 2),
+                                         frozen_type(types.complex64, 4)), ScoringContext)
+score_context_sig = [types.float64[::1](scoring_context_type, array_type(types.int64, 2, True),
+                                        array_type(types.int64, 1, True), array_type(types.int32, 2, True))]
+prefilter_placements_sig = [types.boolean[::1](array_type(types.int64, 2, True), array_type(types.float64, 2, True),
+                                               types.float64, types.float64, types.float64, scoring_context_type)]
+
+@jit(make_ROI_chunk_sig, nopython=True, parallel=True, fastmath= True, cache=True)
+def make_ROI_chunk(voxel_idx, p_chunk, times, BP_Phase, BP_Amp, BP_step, period):
+    """Phase and amplitude from the peak of each trace in one (Nt, Nc) block of sensors as stored in the output file,
+    column s is voxel voxel_idx[s]. The phase is the time of the peak within the source period.
+
+    The running maximum walks the block row by row over groups of columns, so reads stay contiguous.
+    """
+
+    width = 64
+    for g in prange((p_chunk.shape[1] + width - 1) // width):
+        lo = g * width
+        hi = min(lo + width, p_chunk.shape[1])
+
+        peaks = np.zeros(hi - lo, dtype=np.int64)
+        Amp = np.empty(hi - lo, dtype=np.float64)
+        for s in range(lo, hi):
+            Amp[s - lo] = p_chunk[0, s]
+        for t in range(1, p_chunk.shape[0]):
+            for s in range(lo, hi):
+                if p_chunk[t, s] > Amp[s - lo]:
+                    Amp[s - lo] = p_chunk[t, s]
+                    peaks[s - lo] = t
+
+        for s in range(lo, hi):
+            TOF = times[peaks[s - lo]]
+            BP_Phase[voxel_idx[s, 0], voxel_idx[s, 1], voxel_idx[s, 2]] = 2 * np.pi * ((TOF / period) - np.floor(TOF / period))
+            BP_Amp[voxel_idx[s, 0], voxel_idx[s, 1], voxel_idx[s, 2]] = Amp[s - lo]
+            BP_step[voxel_idx[s, 0], voxel_idx[s, 1], voxel_idx[s, 2]] = np.floor(TOF / period)
+
+@jit(make_ROI_chunk_sig, nopython=True, parallel=True, fastmath= True, cache=True)
+def make_ROI_lockin_chunk(voxel_idx, p_chunk, times, BP_Phase, BP_Amp, BP_step, period):
+    """Lock-in version of ``make_ROI_chunk``: phase and amplitude of the Fourier coefficient at 1/period.
+
+    Each sensor keeps one complex sum of p(t) * exp(-i w t) over the rows, so the estimate is not quantised to dt and
+    needs no trace. A wave delayed by TOF has angle -w * TOF, which gives the same phase as the peak time of the
+    single cycle source pulse. The amplitude is scaled to the peak of that pulse; BP_step (whole periods) is left as
+    is because the coefficient does not carry it.
+    """
+
+    width = 64
+    omega = 2 * np.pi / period
+    if times.shape[0] > 1:
+        scale = 2 * (times[1] - times[0]) / period
+    else:
+        scale = 2.0
+
+    for g in prange((p_chunk.shape[1] + width - 1) // width):
+        lo = g * width
+        hi = min(lo + width, p_chunk.shape[1])
+
+        re = np.zeros(hi - lo, dtype=np.float64)
+        im = np.zeros(hi - lo, dtype=np.float64)
+        for t in range(p_chunk.shape[0]):
+            c = np.cos(omega * times[t])
+            d = np.sin(omega * times[t])
+            for s in range(lo, hi):
+                re[s - lo] += p_chunk[t, s] * c
+                im[s - lo] -= p_chunk[t, s] * d
+
+        for s in range(lo, hi):
+            phase = -np.arctan2(im[s - lo], re[s - lo])
+            BP_Phase[voxel_idx[s, 0], voxel_idx[s, 1], voxel_idx[s, 2]] = phase - 2 * np.pi * np.floor(phase / (2 * np.pi))
+            BP_Amp[voxel_idx[s, 0], voxel_idx[s, 1], voxel_idx[s, 2]] = scale * np.sqrt(re[s - lo]**2 + im[s - lo]**2)
+
+@jit(make_field_sig, nopython=True, parallel=True, cache=True)
+def make_field(BP_Phase, BP_Amp, field):
+    """Fill ``field`` (complex64) with BP_Amp * exp(i * BP_Phase) without a complex128 temporary."""
+
+    for i in prange(BP_Phase.shape[0]):
+        for j in range(BP_Phase.shape[1]):
+            for k in range(BP_Phase.shape[2]):
+                field[i, j, k] = BP_Amp[i, j, k] * np.exp(1j * BP_Phase[i, j, k])
+
+    return field
+
+@jit(nopython=True, nogil=True, cache=True)
+def project_cube_halfspace(C, lo, hi, normal, iteration=100):
+    """Closest point to C inside the box [lo, hi] intersected with the half-space normal . p <= 0.
+
+    The KKT point is clip(C - lam * normal) for the multiplier lam >= 0 that puts it on the plane, and
+    normal . clip(C - lam * normal) is monotone in lam, so lam is found by bisection.
+    """
+
+    x = np.minimum(np.maximum(C, lo), hi)
+    if np.dot(x, normal) <= 0:
+        return x
+
+    lam_lo = 0.0
+    lam_hi = np.linalg.norm(C) + np.linalg.norm(hi - lo) + np.linalg.norm(lo)
+    for it in range(iteration):
+        lam = 0.5 * (lam_lo + lam_hi)
+        x = np.minimum(np.maximum(C - lam * normal, lo), hi)
+        if np.dot(x, normal) > 0:
+            lam_lo = lam
+        else:
+            lam_hi = lam
+
+    return np.minimum(np.maximum(C - lam_hi * normal, lo), hi)
+
+@jit(nopython=True, nogil=True, cache=True)
+def cube_hits_cap(v, C, Rs, normal):
+    """True if the voxel cube centred at v (in voxel units) intersects the spherical cap.
+
+    The cap is the part of the sphere |p - C| = Rs lying in the half-space normal . p <= 0 (rim plane through the
+    origin). A voxel is part of the rasterised cap exactly when rounding some cap point lands in it.
+    """
+
+    lo = v - 0.5
+    hi = v + 0.5
+
+    # Sphere against the whole cube
+    dmin = 0.0
+    dmax = 0.0
+    for k in range(3):
+        d = max(lo[k] - C[k], 0.0, C[k] - hi[k])
+        dmin += d * d
+        d = max(abs(lo[k] - C[k]), abs(hi[k] - C[k]))
+        dmax += d * d
+
+    if np.sqrt(dmin) > Rs or np.sqrt(dmax) < Rs:
+        return False
+
+    # Half-space of the cap against the cube
+    centre = np.dot(v, normal)
+    half = 0.5 * (abs(normal[0]) + abs(normal[1]) + abs(normal[2]))
+    if centre - half > 0:
+        return False
+    if centre + half <= 0:
+        return True
+
+    # Cube straddles the rim plane, check the sphere against the clipped cube
+    dmax = 0.0
+    for c in range(8):
+        corner = lo.copy()
+        for k in range(3):
+            if (c >> k) & 1:
+                corner[k] = hi[k]
+
+        a = np.dot(corner, normal)
+        if a <= 0:
+            dmax = max(dmax, np.linalg.norm(corner - C))
+
+        # Edges leaving this corner along each axis, crossing the rim plane
+        for k in range(3):
+            if (c >> k) & 1 or normal[k] == 0:
+                continue
+            t = -a / normal[k]
+            if 0 <= t <= 1:
+                cross = corner.copy()
+                cross[k] += t
+                dmax = max(dmax, np.linalg.norm(cross - C))
+
+    if dmax < Rs:
+        return False
+
+    closest = project_cube_halfspace(C, lo, hi, normal)
+    return np.linalg.norm(closest - C) <= Rs
+
+@jit(nopython=True, nogil=True, cache=True)
+def voxelise_cap(ROC, width, dx, Tnormal):
+    """Exact surface voxels of the spherical cap, without a dense scratch volume.
+
+    The cap is marched voxel by voxel from its apex through 26-connected neighbours, testing each voxel cube against
+    the cap surface, so the work and memory only scale with the number of surface voxels. Returns unique integer
+    offsets (N, 3) in (x, y, z) order relative to the centre of the rim plane, sorted lexicographically.
+    """
+
+    Rs = ROC / 1000 / dx
+    a = 0.5 * width / 1000 / dx
+    H = Rs - np.sqrt(Rs ** 2 - a ** 2)
+
+    normal = Tnormal / np.linalg.norm(Tnormal)
+    C = (Rs - H) * normal
+
+    B = int(np.ceil(np.sqrt(a ** 2 + H ** 2))) + 2
+    side = 2 * B + 1
+
+    seed = ((int(np.round(-H * normal[0])) + B) * side + (int(np.round(-H * normal[1])) + B)) * side \
+           + (int(np.round(-H * normal[2])) + B)
+
+    seen = {seed}
+    queue = [seed]
+    hits = []
+
+    v = np.zeros(3)
+    head = 0
+    while head < len(queue):
+        key = queue[head]
+        head += 1
+
+        X = key // (side * side)
+        Y = (key // side) % side
+        Z = key % side
+
+        v[0] = X - B
+        v[1] = Y - B
+        v[2] = Z - B
+        if not cube_hits_cap(v, C, Rs, normal):
+            continue
+        hits.append(key)
+
+        for i in range(max(X - 1, 0), min(X + 2, side)):
+            for j in range(max(Y - 1, 0), min(Y + 2, side)):
+                for k in range(max(Z - 1, 0), min(Z + 2, side)):
+                    nb = (i * side + j) * side + k
+                    if nb not in seen:
+                        seen.add(nb)
+                        queue.append(nb)
+
+    keys = np.sort(np.array(hits))
+    offsets = np.zeros((keys.shape[0], 3), dtype=np.int64)
+    offsets[:, 0] = keys // (side * side) - B
+    offsets[:, 1] = (keys // side) % side - B
+    offsets[:, 2] = keys % side - B
+
+    return offsets
+
+@jit(make_cap_offsets_sig, nopython=True, nogil=True, cache=True)
+def make_cap_offsets(ROC, width, dx, Tnormal):
+    """Voxelise the spherical cap once and return its unique voxel offsets.
+
+    Offsets are integer (N, 3) arrays in array (z, y, x) order, relative to the integer transducer centre, so that
+    the cap for any centre ``Tcenter`` is simply ``Tcenter[::-1] + offsets``. The shift of the cap towards the focus
+    (``floor(TP_dis * Tnormal)``) is already folded in.
+    """
 
     Tdia = width / 1000
     Troc = ROC / 1000
-    pi = 3.141592653589793
 
     H = Troc - np.sqrt(Troc ** 2 - (0.5 * Tdia) ** 2)
     TP_dis = np.floor(H / dx)
-    move_Tcenter = (Tcenter + TP_dis * Tnormal)
+    shift = np.floor(TP_dis * Tnormal)
+
+    cap = voxelise_cap(ROC, width, dx, Tnormal)
+    offsets = np.zeros(cap.shape, dtype=np.int64)
+
+    offsets[:, 2] = cap[:, 0] + int(shift[0])
+    offsets[:, 1] = cap[:, 1] + int(shift[1])
+    offsets[:, 0] = cap[:, 2] + int(shift[2])
+
+    return offsets
+
+def freeze(array, dtype=None):
+    """Read-only C-contiguous view (memmaps opened with mode 'r' already are)."""
+
+    array = np.ascontiguousarray(array, dtype=dtype)
+    if array.flags.writeable:
+        array = array.view()
+        array.setflags(write=False)
+    return array
+
+def make_scoring_context(FIELD, skullCrop_arr, ROI_range, target_idx, head=None):
+    """Build the ScoringContext once after make_ROI.
+
+    Voxels a cap may not touch (bone, skullCrop_arr > 250, and with ``head`` the inside of the head, head == 0) are
+    bit-packed in C order, 1 bit per voxel instead of the float skull array.
+    """
+
+    blocked = skullCrop_arr > 250
+    if head is not None:
+        blocked = blocked | (head == 0)
+
+    return ScoringContext(ROI_range=freeze(ROI_range, np.int64), shape=freeze(skullCrop_arr.shape, np.int64),
+                          blocked=freeze(np.packbits(blocked, axis=None)),
+                          target_idx=freeze(np.atleast_2d(target_idx), np.int64), FIELD=freeze(FIELD, np.complex64))
+
+def context_blocked(context, index):
+    """Blocked flag of (N, 3) array-order voxel indices."""
+
+    flat = np.ravel_multi_index(tuple(np.asarray(index).T), tuple(context.shape))
+    return ((context.blocked[flat >> 3] >> (7 - (flat & 7))) & 1).astype(bool)
+
+@jit(nopython=True, fastmath= True, cache=True)
+def score_template_context(context, Tcenter, offsets):
+    """Translate a cached cap template to ``Tcenter`` (x, y, z index) and gather its score.
 
-    nH = 2000
-    nD = 2000
-    nA = int(np.floor(0.5 * Tdia / dx) + 5)
-    A = np.zeros((2 * nA + 1, 2 * nA + 1, 2 * nA + 1))
+    A cap leaving the grid, touching a blocked voxel or a voxel outside the ROI (field == 0) scores zero. Otherwise the
+    score is the sum over targets of the magnitude of the summed complex field under the cap.
+    """
 
-    Vs = np.zeros(3)
-    Vs[1] = -Tnormal[2]
-    Vs[2] = Tnormal[1]
+    shape = context.shape
+    blocked = context.blocked
+    FIELD = context.FIELD
 
-    if np.all(Vs == 0):
-        Vs[1] = 0.000000000001
-        Vs[2] = 0.000000000001
+    nS = offsets.shape[0]
+    flat = np.zeros(nS, dtype=np.int64)
+    for p in range(nS):
+        Z = offsets[p, 0] + Tcenter[2]
+        Y = offsets[p, 1] + Tcenter[1]
+        X = offsets[p, 2] + Tcenter[0]
 
-    Vs = Vs / np.linalg.norm(Vs)
-    Vt = np.cross(Tnormal, Vs)
+        if Z < 0 or Z >= shape[0] or Y < 0 or Y >= shape[1] or X < 0 or X >= shape[2]:
+            return 0.0
 
-    for i in range(nH):
-        R = np.sqrt(Troc ** 2 - (Troc - H + i * H / nH) ** 2)
-        for j in range(nD):
-            theta = 2 * pi / nD * j
-            X = int((nA + 1) + np.round(
-                (-(i) * H / nH * Tnormal[0] + R * np.cos(theta) * Vs[0] + R * np.sin(theta) * Vt[0]) / dx))
-            Y = int((nA + 1) + np.round(
-                (-(i) * H / nH * Tnormal[1] + R * np.cos(theta) * Vs[1] + R * np.sin(theta) * Vt[1]) / dx))
-            Z = int((nA + 1) + np.round(
-                (-(i) * H / nH * Tnormal[2] + R * np.cos(theta) * Vs[2] + R * np.sin(theta) * Vt[2]) / dx))
-            A[X, Y, Z] = 1
+        f = (Z * shape[1] + Y) * shape[2] + X
+        if (blocked[f >> 3] >> (7 - (f & 7))) & 1:
+            return 0.0
+        flat[p] = f
 
-    nS = int(np.sum(A))
-    Spos = np.zeros((nS, 4))
-    idx = np.where(A == 1)
+    score = 0.0
+    for i in range(FIELD.shape[0]):
 
-    Spos[:, 2] = idx[0] - (nA + 1) + move_Tcenter[0]
-    Spos[:, 1] = idx[1] - (nA + 1) + move_Tcenter[1]
-    Spos[:, 0] = idx[2] - (nA + 1) + move_Tcenter[2]
+        BP_Field = FIELD[i].ravel()
 
-    return Spos
+        real = 0.0
+        imag = 0.0
+        for p in range(nS):
+            value = BP_Field[flat[p]]
+            if value == 0:
+                return 0.0
 
-@jit(nopython=True, parallel=True, fastmath= True)
-def score_fast(Tcenter, Tnormal,  PHASE, AMP, skullCrop_arr, width, ROC, dx):
+            real += value.real
+            imag += value.imag
 
-    ################################################################################################
-    #### make transducer
-    ################################################################################################
+        score += np.sqrt(real ** 2 + imag ** 2)
+
+    return score
+
+@jit(score_context_sig, nopython=True, parallel=True, fastmath= True, cache=True)
+def score_context(context, centres, ptr, offsets):
+    """Score a population of placements against a ScoringContext.
+
+    Candidate c is centred at ``centres[c]`` (x, y, z index) and uses the cap template
+    ``offsets[ptr[c]:ptr[c + 1]]``; see ``capTemplateCache.lookup_many``.
+    """
+
+    scores = np.zeros(centres.shape[0])
+    for c in prange(centres.shape[0]):
+        scores[c] = score_template_context(context, centres[c], offsets[ptr[c]:ptr[c + 1]])
+
+    return scores
+
+def downsample_block(arr, factor, reduce=np.mean, fill=0):
+    """Reduce the last three axes over factor^3 blocks (padded with ``fill`` at the far edges).
+
+    Used for the coarse levels of the placement search: np.mean on the complex field stack, np.max on the skull
+    (a block is bone if any voxel is) and np.min on the head mask.
+    """
+
+    shape = np.array(arr.shape[-3:])
+    coarse = -(-shape // factor)
+
+    padded = np.full(arr.shape[:-3] + tuple(coarse * factor), fill, dtype=arr.dtype)
+    padded[..., :shape[0], :shape[1], :shape[2]] = arr
+
+    blocks = padded.reshape(arr.shape[:-3] + (coarse[0], factor, coarse[1], factor, coarse[2], factor))
+    return reduce(blocks, axis=(-5, -3, -1)).astype(arr.dtype)
+
+@jit(prefilter_placements_sig, nopython=True, parallel=True, cache=True)
+def prefilter_placements(centres, normals, ROC, width, dx, context):
+    """O(1) rejection of placements that certainly score zero, before any voxelisation.
+
+    Uses only the centre (x, y, z index) and the bowl geometry: the exact bounding box of the cap has to stay in the
+    grid, and the voxels of the apex and of eight rim points (all of which belong to the cap) must not be blocked in
+    the ScoringContext, the mask the score itself rejects on. Normals must be the quantised normals of the cap
+    templates.
+    :return: Boolean array, False for placements that can be skipped.
+    """
 
     Tdia = width / 1000
     Troc = ROC / 1000
@@ -84,85 +406,199 @@ def score_fast(Tcenter, Tnormal,  PHASE, AMP, skullCrop_arr, width, ROC, dx):
 
     H = Troc - np.sqrt(Troc ** 2 - (0.5 * Tdia) ** 2)
     TP_dis = np.floor(H / dx)
-    move_Tcenter = (Tcenter + TP_dis * Tnormal)
-
-    nH = 1500
-    nD = 1500
-    nA = int(np.floor(0.5 * Tdia / dx) + 5)
-    A = np.zeros((2 * nA + 1, 2 * nA + 1, 2 * nA + 1))
-
-    Vs = np.zeros(3)
-    Vs[1] = -Tnormal[2]
-    Vs[2] = Tnormal[1]
-
-    Vs = Vs / np.linalg.norm(Vs)
-    Vt = np.cross(Tnormal, Vs)
-    #print("find point 2", tran_idx)
-    for i in range(nH):
-        R = np.sqrt(Troc ** 2 - (Troc - H + i * H / nH) ** 2)
-        for j in range(nD):
-            theta = 2 * pi / nD * j
-            X = int((nA + 1) + np.round(
-                (-(i) * H / nH * Tnormal[0] + R * np.cos(theta) * Vs[0] + R * np.sin(theta) * Vt[0]) / dx))
-            Y = int((nA + 1) + np.round(
-                (-(i) * H / nH * Tnormal[1] + R * np.cos(theta) * Vs[1] + R * np.sin(theta) * Vt[1]) / dx))
-            Z = int((nA + 1) + np.round(
-                (-(i) * H / nH * Tnormal[2] + R * np.cos(theta) * Vs[2] + R * np.sin(theta) * Vt[2]) / dx))
-            A[X, Y, Z] = 1
-
-    nS = int(np.sum(A))
-    Spos = np.zeros((int(nS), 4))
-    idx = np.where(A == 1)
-
-    Spos[:, 2] = (idx[0] - (nA + 1) + move_Tcenter[0])
-    Spos[:, 1] = (idx[1] - (nA + 1) + move_Tcenter[1])
-    Spos[:, 0] = (idx[2] - (nA + 1) + move_Tcenter[2])
-
-    ################################################################################################
-    #### Check ROI or not
-    ################################################################################################
-
-    if np.any(Spos[:, 0] >= skullCrop_arr.shape[0])\
-            or np.any(Spos[:, 1] >= skullCrop_arr.shape[1])\
-            or np.any(Spos[:, 2] >= skullCrop_arr.shape[2])\
-            or np.any(Spos < 0):
-
-        score = 0
-        return score, Spos
-
-    ################################################################################################
-    #### Calculate score
-    ################################################################################################
-    check = np.zeros(Spos.shape[0])
-    phase = np.zeros(Spos.shape[0])
-    amp = np.zeros(Spos.shape[0])
-
-    gather_score = []
-    for i in range(len(PHASE)):
-
-        BP_Phase = PHASE[i]
-        BP_Amp = AMP[i]
-
-        for p in range(Spos.shape[0]):
-            check[p] = skullCrop_arr[int(Spos[p, 0]), int(Spos[p, 1]), int(Spos[p, 2])]
-            phase[p] = BP_Phase[int(Spos[p, 0]), int(Spos[p, 1]), int(Spos[p, 2])]
-            amp[p] = BP_Amp[int(Spos[p, 0]), int(Spos[p, 1]), int(Spos[p, 2])]
-
-        if np.any(amp == 0) or np.any(check > 250):
-            score = 0
-            return score, Spos
-
-        temp = np.zeros((Spos.shape[0], 2))
-        temp[:,0] = np.multiply(amp,  np.cos(phase))
-        temp[:,1] = np.multiply(amp,  np.sin(phase))
-        temp_sum = np.sum(temp, axis=0)
-
-        score_at1 = np.abs(np.complex(temp_sum[0], temp_sum[1]))
-        gather_score.append(score_at1)
-
-    score = np.sum(np.array(gather_score))
-
-    return score, Spos
+
+    Rs = Troc / dx
+    a = 0.5 * Tdia / dx
+    Hv = H / dx
+    cos_aperture = (Rs - Hv) / Rs
+
+    shape = context.shape
+    blocked = context.blocked
+
+    feasible = np.ones(centres.shape[0], dtype=np.bool_)
+    for c in prange(centres.shape[0]):
+        normal = normals[c]
+        base = np.zeros(3)
+        for e in range(3):
+            base[e] = centres[c, e] + np.floor(TP_dis * normal[e])
+
+        # Cap bounding box: extremes are on the rim circle or at the extreme points of the sphere when those lie on the cap
+        for e in range(3):
+            r = a * np.sqrt(max(1 - normal[e] ** 2, 0.0))
+            lo = -r
+            hi = r
+            if normal[e] >= cos_aperture:
+                lo = min(lo, (Rs - Hv) * normal[e] - Rs)
+            if -normal[e] >= cos_aperture:
+                hi = max(hi, (Rs - Hv) * normal[e] + Rs)
+
+            if base[e] + np.round(lo) < 0 or base[e] + np.round(hi) >= shape[2 - e]:
+                feasible[c] = False
+        if not feasible[c]:
+            continue
+
+        # Probe voxels on the cap
+        Vs = np.zeros(3)
+        Vs[1] = -normal[2]
+        Vs[2] = normal[1]
+        if np.all(Vs == 0):
+            Vs[1] = 1.0
+        Vs = Vs / np.linalg.norm(Vs)
+        Vt = np.cross(normal, Vs)
+
+        for k in range(9):
+            if k == 0:
+                q = -Hv * normal
+            else:
+                theta = 2 * pi / 8 * k
+                q = a * (np.cos(theta) * Vs + np.sin(theta) * Vt)
+
+            X = int(base[0] + np.round(q[0]))
+            Y = int(base[1] + np.round(q[1]))
+            Z = int(base[2] + np.round(q[2]))
+
+            f = (Z * shape[1] + Y) * shape[2] + X
+            if (blocked[f >> 3] >> (7 - (f & 7))) & 1:
+                feasible[c] = False
+                break
+
+    return feasible
+
+@jit(nopython=True, parallel=True, cache=True)
+def scalp_distance(origin, directions, head, step=0.5):
+    """Distance (in voxels) from origin to the outermost head voxel along each ray.
+
+    origin and directions are in (x, y, z) index order like the transducer centre, head is 0 inside the head.
+    Rays that never meet the head get 0.
+    """
+
+    distance = np.zeros(directions.shape[0])
+    for r in prange(directions.shape[0]):
+        t = 0.0
+        while True:
+            X = int(np.round(origin[0] + t * directions[r, 0]))
+            Y = int(np.round(origin[1] + t * directions[r, 1]))
+            Z = int(np.round(origin[2] + t * directions[r, 2]))
+
+            if X < 0 or Y < 0 or Z < 0 or Z >= head.shape[0] or Y >= head.shape[1] or X >= head.shape[2]:
+                break
+            if head[Z, Y, X] == 0:
+                distance[r] = t
+            t += step
+
+    return distance
+
+class capTemplateCache():
+    """Cache of spherical-cap voxel templates keyed by (ROC, width, dx, quantised normal).
+
+    The cap only has to be rasterised once per orientation; afterwards scoring a placement is a translate-and-gather
+    through ``score_template_context``. The normal is quantised on a ``normal_step`` lattice before rasterisation, so every
+    normal that maps to the same key gets exactly the same voxels. The least recently used templates are dropped once
+    ``maxsize`` is reached.
+    """
+
+    def __init__(self, ROC, width, dx, normal_step=0.005, maxsize=1024):
+
+        self.ROC = ROC
+        self.width = width
+        self.dx = dx
+        self.normal_step = normal_step
+        self.maxsize = maxsize
+
+        self.templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def matches(self, ROC, width, dx):
+
+        return (self.ROC, self.width, self.dx) == (ROC, width, dx)
+
+    def key(self, Tnormal):
+
+        Tnormal = np.array(Tnormal, dtype=float)
+        Tnormal = Tnormal / np.linalg.norm(Tnormal)
+
+        return tuple(np.round(Tnormal / self.normal_step).astype(int))
+
+    def keys(self, Tnormals):
+        """Keys of an (S, 3) array of normals, same as ``key`` row by row."""
+
+        Tnormals = Tnormals / np.linalg.norm(Tnormals, axis=1)[:, None]
+
+        return [tuple(row) for row in np.round(Tnormals / self.normal_step).astype(int).tolist()]
+
+    def quantised_normal(self, key):
+
+        Tnormal = np.array(key, dtype=float) * self.normal_step
+        return Tnormal / np.linalg.norm(Tnormal)
+
+    def quantise(self, Tnormals):
+        """Quantised normals (the ones the templates are built from) for an (S, 3) array of normals."""
+
+        Tnormals = Tnormals / np.linalg.norm(Tnormals, axis=1)[:, None]
+        Tnormals = np.round(Tnormals / self.normal_step) * self.normal_step
+
+        return Tnormals / np.linalg.norm(Tnormals, axis=1)[:, None]
+
+    def lookup(self, Tnormal):
+        """Return the (N, 3) array-order voxel offsets of the cap for the given orientation."""
+
+        return self.lookup_key(self.key(Tnormal))
+
+    def lookup_key(self, key):
+
+        offsets = self.templates.get(key)
+        if offsets is not None:
+            self.hits += 1
+            self.templates.move_to_end(key)
+            return offsets
+
+        self.misses += 1
+        offsets = make_cap_offsets(self.ROC, self.width, self.dx, self.quantised_normal(key))
+        offsets = offsets.astype(np.int32)
+
+        self.templates[key] = offsets
+        if len(self.templates) > self.maxsize:
+            self.templates.popitem(last=False)
+
+        return offsets
+
+    def lookup_many(self, Tnormals, workers=None):
+        """Templates for a batch of orientations packed for ``score_context``.
+
+        Missing templates are voxelised concurrently (the kernels release the GIL).
+        :return: Tuple of (ptr, offsets) where candidate c uses offsets[ptr[c]:ptr[c + 1]].
+        """
+
+        keys = self.keys(np.array(Tnormals, dtype=float).reshape(-1, 3))
+        missing = [key for key in dict.fromkeys(keys) if key not in self.templates]
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                built = pool.map(lambda key: make_cap_offsets(self.ROC, self.width, self.dx, self.quantised_normal(key)),
+                                 missing)
+                built = dict(zip(missing, built))
+        else:
+            built = {}
+
+        templates = []
+        for key in keys:
+            if key in built:
+                self.misses += 1
+                offsets = built.pop(key).astype(np.int32)
+                self.templates[key] = offsets
+                if len(self.templates) > self.maxsize:
+                    self.templates.popitem(last=False)
+            else:
+                offsets = self.lookup_key(key)
+            templates.append(offsets)
+
+        ptr = np.zeros(len(templates) + 1, dtype=np.int64)
+        ptr[1:] = np.cumsum([offsets.shape[0] for offsets in templates])
+
+        if templates:
+            return ptr, np.concatenate(templates)
+        return ptr, np.zeros((0, 3), dtype=np.int32)
 
 def neper2db(alpha, y):
 
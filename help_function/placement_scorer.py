@@ -0,0 +1,410 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import numba
+from collections import OrderedDict
+from multiprocessing import get_context
+
+from help_function import help_function as hlp
+
+l2n = lambda l: np.array(l)
+n2l = lambda n: list(n)
+
+
+# Two unit vectors perpendicular to each (S, 3) unit vector
+def orthonormal(vectors):
+
+    helper = np.zeros_like(vectors)
+    helper[:, 0] = 1
+    helper[np.abs(vectors[:, 0]) > 0.9] = (0, 1, 0)
+
+    b1 = np.cross(vectors, helper)
+    b1 = b1 / np.linalg.norm(b1, axis=1)[:, None]
+    b2 = np.cross(vectors, b1)
+
+    return b1, b2
+
+
+# Unit normals tilted away from the (S, 3) unit axes, tilt and azimuth in [0, 1], uniform in solid angle within angle
+def cone_normals(axis, tilt, azimuth, angle):
+
+    cos_tilt = 1 - tilt * (1 - np.cos(np.deg2rad(angle) * (1 - 1e-6)))
+    sin_tilt = np.sqrt(np.clip(1 - cos_tilt ** 2, 0, 1))
+    b1, b2 = orthonormal(axis)
+    azimuth = 2 * np.pi * azimuth
+
+    return (cos_tilt[:, None] * axis
+            + sin_tilt[:, None] * (np.cos(azimuth)[:, None] * b1 + np.sin(azimuth)[:, None] * b2))
+
+
+class placementScoreCache():
+    """Bounded LRU memo of placement scores keyed by (integer centre, quantised normal key).
+
+    Two placements with the same key rasterise to the same voxels, so their score is identical; once the DE population
+    converges most candidates are such duplicates.
+    """
+
+    def __init__(self, maxsize=100000):
+
+        self.maxsize = maxsize
+
+        self.scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+
+        score = self.scores.get(key)
+        if score is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.scores.move_to_end(key)
+        return score
+
+    def put(self, key, score):
+
+        self.scores[key] = score
+        if len(self.scores) > self.maxsize:
+            self.scores.popitem(last=False)
+
+    def hit_rate(self):
+
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class placementScorer():
+    """Scores transducer placements (normalized centre + normal) against the back-propagation maps.
+
+    The scorer only holds what a score needs (a ScoringContext with the maps, packed blocked-voxel mask, ROI ranges
+    and targets, plus the transducer spec), so it can be sent to worker processes instead of the whole makeSimulation object. After ``share()`` the arrays are dumped
+    once to .npy files (RAM backed /dev/shm when available) and pickled copies re-open them as read-only memmaps, so
+    every worker maps the same pages instead of receiving a copy.
+    """
+
+    def __init__(self, FIELD, skullCrop_arr, ROI_range, target_idx, ROC, width, dx, normal_angle=20, capCache=None,
+                 prefilter=False, space=None, memo_size=100000, head=None):
+
+        self.context = hlp.make_scoring_context(FIELD, skullCrop_arr, ROI_range, target_idx, head)
+
+        # O(1) feasibility prefilter on the blocked mask of the context
+        self.prefilter = prefilter
+
+        self.normal_angle = normal_angle
+
+        self.ROC = ROC
+        self.width = width
+        self.dx = dx
+
+        if capCache is None:
+            capCache = hlp.capTemplateCache(ROC, width, dx)
+        self.capCache = capCache
+        self.memo = placementScoreCache(memo_size)
+
+        # Optional search space replacing the ROI box parametrisation (e.g. scalpSearchSpace)
+        self.space = space
+
+        self.share_dir = None
+
+    @property
+    def ROI_range(self):
+        return self.context.ROI_range
+
+    @property
+    def target_idx(self):
+        return self.context.target_idx[0]
+
+    # Map optimizer parameters (normalized centre, normal) to transducer centre index and unit normal
+    def decode(self, Input_data):
+
+        Input_data = np.atleast_2d(Input_data)
+        if self.space is not None:
+            return self.space.decode(Input_data)
+
+        ROI_range = self.ROI_range
+
+        TCenter = Input_data[:, :3]*(ROI_range[:, 1] - ROI_range[:, 0]) + ROI_range[:, 0]
+        TCenter = TCenter.astype(np.int64)
+
+        Tnormal = Input_data[:, 3:]
+        Tnormal = Tnormal/np.linalg.norm(Tnormal, axis=1)[:, None]
+
+        return TCenter, Tnormal
+
+    # Normal vector has to point toward the (first) target within normal_angle
+    def check_angle(self, TCenter, Tnormal):
+
+        standard_vector = self.target_idx[None, :] - TCenter
+        standard_vector = standard_vector/np.linalg.norm(standard_vector, axis=1)[:, None]
+
+        dot_product = np.clip(np.sum(Tnormal*standard_vector, axis=1), -1, 1)
+        angle = np.abs(np.rad2deg(np.arccos(dot_product)))
+
+        return angle <= self.normal_angle
+
+    # Angle check and, when enabled, the feasibility prefilter
+    def feasible(self, TCenter, Tnormal):
+
+        valid = self.check_angle(TCenter, Tnormal)
+
+        if self.prefilter and np.any(valid):
+            valid[valid] = hlp.prefilter_placements(TCenter[valid], self.capCache.quantise(Tnormal[valid]), self.ROC,
+                                                    self.width, self.dx, self.context)
+        return valid
+
+    def evaluate(self, Input_data):
+        """Score a (S, D) block of candidates.
+
+        :return: Tuple of (score, TCenter, Tnormal, valid), valid marks candidates that passed the angle check and
+                 the feasibility prefilter and were actually scored.
+        """
+
+        TCenter, Tnormal = self.decode(Input_data)
+        valid = self.feasible(TCenter, Tnormal)
+
+        score = np.zeros(TCenter.shape[0])
+        if np.any(valid):
+            index = np.flatnonzero(valid)
+            keys = zip(map(tuple, TCenter[index].tolist()), self.capCache.keys(Tnormal[index]))
+
+            # Score every key missing from the memo once
+            pending = OrderedDict()
+            for i, key in zip(index, keys):
+                if key in pending:
+                    self.memo.hits += 1
+                    pending[key].append(i)
+                    continue
+
+                cached = self.memo.get(key)
+                if cached is None:
+                    pending[key] = [i]
+                else:
+                    score[i] = cached
+
+            if pending:
+                first = [rows[0] for rows in pending.values()]
+                ptr, offsets = self.capCache.lookup_many(Tnormal[first])
+                fresh = hlp.score_context(self.context, TCenter[first], ptr, offsets)
+
+                for (key, rows), value in zip(pending.items(), fresh):
+                    self.memo.put(key, value)
+                    score[rows] = value
+
+        return score, TCenter, Tnormal, valid
+
+    def share(self, share_dir=None):
+        """Dump the maps once to .npy files so that pickled copies of the scorer re-open them as memmaps."""
+
+        if self.share_dir is not None:
+            return self.share_dir
+
+        if share_dir is None:
+            share_dir = tempfile.mkdtemp(prefix='score_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        else:
+            os.makedirs(share_dir, exist_ok=True)
+
+        for name, array in self.__shared_arrays().items():
+            np.save(os.path.join(share_dir, name + '.npy'), array)
+
+        self.share_dir = share_dir
+        return share_dir
+
+    def release(self):
+        """Remove the shared files again."""
+
+        if self.share_dir is not None:
+            shutil.rmtree(self.share_dir, ignore_errors=True)
+            self.share_dir = None
+
+    def __shared_arrays(self):
+        return {'FIELD': self.context.FIELD, 'blocked': self.context.blocked}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.share_dir is not None:
+            names = list(self.__shared_arrays())
+            state['shared_names'] = names
+            state['context'] = self.context._replace(**{name: None for name in names
+                                                        if name in hlp.ScoringContext._fields})
+            for name in names:
+                if name not in hlp.ScoringContext._fields:
+                    state[name] = None
+
+        # Workers build their own templates
+        cache = self.capCache
+        state['capCache'] = hlp.capTemplateCache(cache.ROC, cache.width, cache.dx,
+                                                 normal_step=cache.normal_step, maxsize=cache.maxsize)
+        state['memo'] = placementScoreCache(self.memo.maxsize)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        if self.share_dir is not None:
+            for name in self.shared_names:
+                array = np.asarray(np.load(os.path.join(self.share_dir, name + '.npy'), mmap_mode='r'))
+                if name in hlp.ScoringContext._fields:
+                    self.context = self.context._replace(**{name: array})
+                else:
+                    setattr(self, name, array)
+
+        # Unpickled arrays are writable again, the kernels take the frozen context only
+        self.context = hlp.ScoringContext(*(hlp.freeze(array) for array in self.context))
+
+
+class scalpSearchSpace():
+    """Placements parametrised on the scalp around the target instead of the ROI box.
+
+    The five parameters in [0, 1] are a direction from the target (polar angle within ``cone`` around ``axis`` and
+    azimuth), the gap between scalp and bowl rim, and the tilt of the normal away from the target direction (magnitude
+    within ``normal_angle`` and azimuth). The scalp distance is ray-marched through the head mask once on a polar x
+    azimuth table and interpolated bilinearly, so nearly every sample sits just outside the head and passes the
+    angle check by construction.
+    """
+
+    bounds = [(0, 1), (0, 1), (0, 1), (0, 1), (0, 1)]
+
+    def __init__(self, head, target_idx, axis, ROC, width, dx, normal_angle=20, cone=180, standoff=(0, 10),
+                 table_shape=(64, 128)):
+
+        self.target_idx = l2n(target_idx).astype(float)
+        self.normal_angle = normal_angle
+        self.cone = cone
+
+        # Bowl height and scalp-rim gap in voxels
+        Troc = ROC / 1000
+        Tdia = width / 1000
+        self.H = (Troc - np.sqrt(Troc ** 2 - (0.5 * Tdia) ** 2)) / dx
+        self.standoff = l2n(standoff) / (dx * 1000)
+
+        self.axis = l2n(axis) / np.linalg.norm(axis)
+        self.frame = orthonormal(self.axis[None, :])
+
+        # Scalp distance table, rows: polar parameter 0..1, columns: azimuth parameter 0..1 (periodic)
+        n_polar, n_azimuth = table_shape
+        u, v = np.meshgrid(np.linspace(0, 1, n_polar), np.arange(n_azimuth) / n_azimuth, indexing='ij')
+        directions = self.direction(u.ravel(), v.ravel())
+        self.scalp = hlp.scalp_distance(self.target_idx, directions, head).reshape(table_shape)
+
+    def direction(self, u, v):
+
+        cos_polar = 1 - u * (1 - np.cos(np.deg2rad(self.cone)))
+        sin_polar = np.sqrt(np.clip(1 - cos_polar ** 2, 0, 1))
+        azimuth = 2 * np.pi * v
+
+        b1, b2 = self.frame
+        return (cos_polar[:, None] * self.axis[None, :]
+                + sin_polar[:, None] * (np.cos(azimuth)[:, None] * b1 + np.sin(azimuth)[:, None] * b2))
+
+    def scalp_distance(self, u, v):
+
+        n_polar, n_azimuth = self.scalp.shape
+
+        fu = u * (n_polar - 1)
+        i0 = np.clip(np.floor(fu).astype(int), 0, n_polar - 2)
+        du = fu - i0
+
+        fv = v * n_azimuth
+        j0 = np.floor(fv).astype(int)
+        dv = fv - j0
+        j0 = j0 % n_azimuth
+        j1 = (j0 + 1) % n_azimuth
+
+        scalp = self.scalp
+        return ((1 - du) * ((1 - dv) * scalp[i0, j0] + dv * scalp[i0, j1])
+                + du * ((1 - dv) * scalp[i0 + 1, j0] + dv * scalp[i0 + 1, j1]))
+
+    def decode(self, Input_data):
+
+        Input_data = np.atleast_2d(Input_data)
+        u, v, gap, tilt, tilt_azimuth = Input_data.T
+
+        # Bowl apex on the ray, rim plane (H closer to the target) a gap above the scalp
+        distance = self.scalp_distance(u, v) + self.H + self.standoff[0] + gap * (self.standoff[1] - self.standoff[0])
+        TCenter = np.round(self.target_idx[None, :] + distance[:, None] * self.direction(u, v)).astype(np.int64)
+
+        # Tilt the normal away from the direction to the target
+        to_target = self.target_idx[None, :] - TCenter
+        to_target = to_target / np.linalg.norm(to_target, axis=1)[:, None]
+
+        return TCenter, cone_normals(to_target, tilt, tilt_azimuth, self.normal_angle)
+
+
+# Scorer of the current worker process, set once by the pool initializer
+_worker_scorer = None
+
+
+def _init_worker(scorer, threads):
+    global _worker_scorer
+    _worker_scorer = scorer
+    numba.set_num_threads(max(1, min(threads, numba.config.NUMBA_NUM_THREADS)))
+
+
+def _evaluate_chunk(Input_data):
+    result = _worker_scorer.evaluate(Input_data)
+    cache, memo = _worker_scorer.capCache, _worker_scorer.memo
+    return os.getpid(), (cache.hits, cache.misses, memo.hits, memo.misses), result
+
+
+class placementScorerPool():
+    """Process pool evaluating populations with a shared placementScorer.
+
+    The scorer is pickled once per worker (with its maps shared as memmaps), each generation is split into one
+    chunk per worker and the partial results are concatenated back in population order. Every worker keeps its own
+    template cache and score memo across generations, their counts are added to the scorer's when the pool is closed. Workers are spawned on every
+    platform: a forked child would inherit numba's thread pool of the parent and can hang it at exit, and only a
+    pickled scorer re-opens the shared memmaps. Scripts using the pool therefore need the ``__main__`` guard.
+    """
+
+    def __init__(self, scorer, processes=None, threads=1):
+
+        self.scorer = scorer
+        self.processes = processes or os.cpu_count()
+        self.threads = threads
+        self.pool = None
+        self.cache_counts = {}
+
+    def open(self):
+        self.scorer.share()
+        self.pool = get_context('spawn').Pool(self.processes, initializer=_init_worker, initargs=(self.scorer, self.threads))
+
+    def close(self, terminate=False):
+        # Workers finish the queued chunks unless the optimizer failed
+        if self.pool is not None:
+            if terminate:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.scorer.release()
+
+        cache, memo = self.scorer.capCache, self.scorer.memo
+        for cache_hits, cache_misses, memo_hits, memo_misses in self.cache_counts.values():
+            cache.hits += cache_hits
+            cache.misses += cache_misses
+            memo.hits += memo_hits
+            memo.misses += memo_misses
+        self.cache_counts = {}
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(terminate=exc_type is not None)
+
+    def evaluate(self, Input_data):
+
+        Input_data = np.atleast_2d(Input_data)
+        chunks = [chunk for chunk in np.array_split(Input_data, self.processes) if chunk.shape[0] > 0]
+        results = []
+        for pid, counts, result in self.pool.map(_evaluate_chunk, chunks):
+            # Running totals of the worker, the latest is kept
+            self.cache_counts[pid] = counts
+            results.append(result)
+
+        return tuple(np.concatenate(part) for part in zip(*results))
@@ -0,0 +1,98 @@
+import os
+import shutil
+import hashlib
+import threading
+import numpy as np
+
+l2n = lambda l: np.array(l)
+n2l = lambda n: list(n)
+
+
+class runCache():
+    """Content-addressed disk cache of solver runs and the maps derived from them.
+
+    An entry is a directory named by the sha256 of everything that defines a run (``key``), holding files such as the
+    k-Wave output and the BP maps. Files are written under a temporary name and renamed, so an interrupted or
+    concurrent writer never leaves a partial file behind. Once the cache is larger than ``max_bytes`` the least
+    recently used entries are removed; a lookup counts as a use.
+    """
+
+    def __init__(self, directory, max_bytes=20e9):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Hex digest of arrays, numbers and strings, arrays by dtype, shape and content."""
+
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                part = np.ascontiguousarray(part)
+                digest.update(repr((part.dtype.str, part.shape)).encode())
+                digest.update(part.data)
+            else:
+                digest.update(repr(part).encode())
+            digest.update(b'|')
+
+        return digest.hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def lookup(self, key, name):
+        """Path of the cached file, None on a miss."""
+
+        path = os.path.join(self.entry(key), name)
+        if not os.path.isfile(path):
+            return None
+
+        os.utime(self.entry(key))
+        return path
+
+    def store(self, key, name, source=None, arrays=None):
+        """Move the file ``source`` (or save the dict ``arrays`` as npz) into the entry and return its cache path."""
+
+        os.makedirs(self.entry(key), exist_ok=True)
+        path = os.path.join(self.entry(key), name)
+        temp = path + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+
+        if source is not None:
+            shutil.move(source, temp)
+        else:
+            with open(temp, 'wb') as file:
+                np.savez(file, **arrays)
+        os.replace(temp, path)
+        os.utime(self.entry(key))
+
+        self.evict(keep=key)
+        return path
+
+    def size(self, key):
+
+        entry = self.entry(key)
+        return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in max_bytes, never the entry ``keep``."""
+
+        with self.lock:
+            entries = []
+            for key in os.listdir(self.directory):
+                try:
+                    entries.append((os.path.getmtime(self.entry(key)), self.size(key), key))
+                except OSError:
+                    continue
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                shutil.rmtree(self.entry(key), ignore_errors=True)
+                total -= size
@@ -29,16 +29,93 @@
  * If not, see [http://www.gnu.org/licenses/](http://www.gnu.org/licenses/).
  *
 """
+from collections import deque, namedtuple
+from concurrent.futures import Future
 from enum import Enum
 from typing import List
 
+import re
+import signal
 import subprocess
+import sys
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from kwave_function.kwave_input_file import KWaveInputFile
 from kwave_function.kwave_output_file import KWaveOutputFile, SensorSamplingType, DomainSamplingType
 
 import os
 upper_path = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+default_binary = os.path.join(upper_path, 'kwave_core',
+                              'kspaceFirstOrder-CUDA.exe' if os.name == 'nt' else 'kspaceFirstOrder-CUDA')
+
+# Progress line of the solver: |  5%  |  3.870s  |  72.120s  | 19/09/21 14:30:59 |
+progress_pattern = re.compile(r'^\|\s*(\d+(?:\.\d+)?)%\s*\|\s*([\d.]+)s\s*\|\s*([\d.]+)s\s*\|')
+
+KWaveProgress = namedtuple('KWaveProgress', ['percent', 'elapsed', 'eta'])
+
+
+class KWaveRunError(RuntimeError):
+    """Solver run which did not finish successfully."""
+    def __init__(self, message, return_code=None, output=''):
+        """
+        :param message:     Error description.
+        :param return_code: Exit code of the solver, None when it was not started or killed by the driver.
+        :param output:      Last lines of the solver output.
+        """
+        super().__init__(message + ('\n' + output if output else ''))
+        self.return_code = return_code
+        self.output = output
+
+
+class KWaveTimeoutError(KWaveRunError):
+    """Solver run killed after exceeding its wall-clock limit."""
+
+
+class KWaveRun(Future):
+    """Future of a solver run started by KWaveBinaryDriver.run_async. The result is the output file.
+
+    The future stays pending while the solver runs, so cancel() succeeds until the run is finished and kills the solver.
+    progress holds the last KWaveProgress reported by the solver (None before the first one).
+    """
+    def __init__(self):
+        super().__init__()
+        self.process = None
+        self.progress = None
+        self.killed = None
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        if not super().cancel():
+            return False
+        self.kill('cancelled')
+        return True
+
+    def kill(self, reason):
+        with self.lock:
+            if self.killed is None:
+                self.killed = reason
+            if self.process is not None:
+                kill_tree(self.process)
+
+
+# Kill the solver with everything it started (a wrapper script may run the binary as its child and those keep the
+# output pipe open). The solver runs in its own session, so on POSIX its process group is exactly that tree
+def kill_tree(proc):
+    if os.name == 'nt':
+        if proc.poll() is None:
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(proc.pid)], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
 
 class KWaveBinaryDriver(object):
     """Represents k-Wave solver."""
@@ -47,14 +124,22 @@ class KWaveBinaryDriver(object):
         ADVANCED = 1
         FULL = 2
 
-    def __init__(self, start_sampling_time=0, binary_path= upper_path +'\kwave_core\kspaceFirstOrder-CUDA.exe', reorder_data=False):
+    def __init__(self, start_sampling_time=0, binary_path=default_binary, reorder_data=False, threads=None,
+                 memory_limit=None):
         """Constructor of k-Wave solver object.
 pyt
         :param start_sampling_time: First time-step which will be sampled and store as the output.
         :param binary_path:         Path to k-Wave solver binary.
         :param reorder_data:        Whether input file was created with data reordering enabled.
+        :param threads:             Number of solver threads (OMP_NUM_THREADS), solver default when None.
+        :param memory_limit:        Address space limit of the solver process in bytes, applied on Linux only. Meant
+                                    for the CPU binary, CUDA reserves far more address space than it uses. Best
+                                    effort: the limit is set on the started process, so allocations the solver makes
+                                    before it (start-up, not the simulation arrays) are not bounded.
         """
         self.start_sampling_time = start_sampling_time
+        self.threads = threads
+        self.memory_limit = memory_limit
         self.binary_path = binary_path
         self.sampling_list = {
             'pressure_at_sensor': [], 'pressure_everywhere': [],
@@ -104,34 +189,117 @@ pyt
         for sampling_type in set(sampling_types):
             self.sampling_list['velocity_everywhere'].append('u_{}'.format(sampling_type.value))
 
-    def run(self, input_file: KWaveInputFile, output_file: KWaveOutputFile, time_steps=None):
-        """Execute k-Wave solver binary with specified input file to generate specified output file.
+    def run(self, input_file: KWaveInputFile, output_file: KWaveOutputFile, time_steps=None, timeout=None):
+        """Execute k-Wave solver binary with specified input file to generate specified output file. Blocks until the
+           solver is finished, its output is printed as it comes.
+
+        :param input_file:  Previously generated input file (see KWaveInputFile).
+        :param output_file: Previously created output file (see KWaveOutputFile)
+        :param time_steps:  Ignores number of time-steps specified in the input file when set.
+        :param timeout:     Wall-clock limit of the run in seconds, None for no limit.
+        :raises KWaveRunError: When the solver exits with non-zero code (KWaveTimeoutError when it is killed).
+        """
+        return self.run_async(input_file, output_file, time_steps, timeout=timeout, echo=True).result()
+
+    def run_async(self, input_file: KWaveInputFile, output_file: KWaveOutputFile, time_steps=None, timeout=None,
+                  progress=None, echo=False):
+        """Start k-Wave solver binary in the background and return its KWaveRun future.
 
         :param input_file:  Previously generated input file (see KWaveInputFile).
         :param output_file: Previously created output file (see KWaveOutputFile)
         :param time_steps:  Ignores number of time-steps specified in the input file when set.
+        :param timeout:     Wall-clock limit of the run in seconds, the solver is killed after it. None for no limit.
+        :param progress:    Called with a KWaveProgress for every progress line of the solver (from the driver thread).
+        :param echo:        Print the solver output.
+        :return: KWaveRun future, result() returns the output file or raises KWaveRunError.
         """
         exec_args = {'i': input_file.file_name, 'o': output_file.file_name}
+        if self.start_sampling_time > 0:
+            # The solver counts time-steps from 1
+            exec_args['s'] = self.start_sampling_time + 1
+        output_file.start_sampling_time = self.start_sampling_time
         # if time_steps is not None:
         #     exec_args['benchmark'] = time_steps
-        exec_command = self.binary_path + self.__build_exec_command(exec_args)
+        # Argument list, so paths with spaces work and no shell is needed on any platform
+        exec_command = [self.binary_path] + self.__build_exec_command(exec_args)
+
+
+        env = None
+        if self.threads is not None:
+            env = dict(os.environ, OMP_NUM_THREADS=str(self.threads))
+
+        run = KWaveRun()
+        try:
+            proc = subprocess.Popen(exec_command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True, errors='replace', bufsize=1, start_new_session=True)
+        except OSError as error:
+            run.set_running_or_notify_cancel()
+            run.set_exception(KWaveRunError("k-Wave solver could not be started: {}".format(error)))
+            return run
+        self.__limit_memory(proc)
+
+        with run.lock:
+            run.process = proc
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, run.kill, ('timeout',))
+            timer.daemon = True
+            timer.start()
+
+        threading.Thread(target=self.__watch, args=(run, proc, output_file, timeout, timer, progress, echo),
+                         daemon=True).start()
+        return run
+
+    @staticmethod
+    def __watch(run, proc, output_file, timeout, timer, progress, echo):
+        # Driver thread of one run: forwards the output, parses progress lines and resolves the future
+        tail = deque(maxlen=20)
+        for line in proc.stdout:
+            tail.append(line)
+            if echo:
+                sys.stdout.write(line)
+            match = progress_pattern.match(line.strip())
+            if match is not None:
+                run.progress = KWaveProgress(*(float(group) for group in match.groups()))
+                if progress is not None:
+                    progress(run.progress)
+        proc.stdout.close()
+        return_code = proc.wait()
+        if timer is not None:
+            timer.cancel()
 
+        # A cancelled future is already resolved
+        if not run.set_running_or_notify_cancel():
+            return
 
-        proc = subprocess.Popen(exec_command)
-        proc.communicate()
-        returnCode = proc.poll()
+        output = ''.join(tail)
+        if run.killed == 'timeout':
+            run.set_exception(KWaveTimeoutError("k-Wave solver killed after {}s!".format(timeout), None, output))
+        elif return_code != 0:
+            run.set_exception(KWaveRunError("k-Wave solver exited with code {}!".format(return_code), return_code,
+                                            output))
+        else:
+            run.set_result(output_file)
 
-        #proc = subprocess.run(exec_command, shell=True, check=True)
-        #proc = subprocess.Popen(exec_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    def __limit_memory(self, proc):
+        # Best effort: prlimit on the started process instead of preexec_fn, which is unsafe while the driver
+        # threads of other runs are alive. The solver may already be running when the limit lands, but its
+        # simulation arrays are allocated after reading the input file, well after the start
+        if self.memory_limit is None or resource is None or not hasattr(resource, 'prlimit'):
+            return
+        try:
+            resource.prlimit(proc.pid, resource.RLIMIT_AS, (int(self.memory_limit), int(self.memory_limit)))
+        except (ProcessLookupError, PermissionError):
+            pass
 
     def __build_exec_command(self, key_value_args):
-        exec_command = ""
+        exec_command = []
         for key, value in key_value_args.items():
-            exec_command += ' --{} {}'.format(key, value) if len(key) > 1 else ' -{} {}'.format(key, value)
+            exec_command += ['--{}'.format(key) if len(key) > 1 else '-{}'.format(key), str(value)]
 
         for sampler_type in self.sampling_list.values():
             for value in sampler_type:
-                exec_command += ' --{}'.format(value) if len(value) > 1 else ' -{}'.format(value)
+                exec_command.append('--{}'.format(value) if len(value) > 1 else '-{}'.format(value))
 
 
         return exec_command
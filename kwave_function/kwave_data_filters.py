@@ -30,7 +30,7 @@
 """
 
 import numpy as np
-from scipy.signal import blackman
+from scipy.signal.windows import blackman
 from scipy.interpolate import interpn
 
 
@@ -96,6 +96,10 @@ class InterpDataFilter(object):
         if any(map(lambda o: abs(o) > 1, offset)):
             raise ValueError("Invalid offset specified (must be less than 1)!")
 
+        shifted = [i for i in range(0, len(data.shape)) if offset[i] != 0]
+        if len(shifted) == 1:
+            return InterpDataFilter.__staggered_axis(data, shifted[0], offset[shifted[0]])
+
         grid = tuple(map(np.arange, data.shape))
         mesh = np.array(np.meshgrid(*tuple(map(lambda d: d[0] + d[1], zip(grid, offset))), indexing='ij'))
         mesh = np.moveaxis(mesh, 0, len(data.shape)).reshape(data.shape + (len(data.shape),))
@@ -112,3 +116,45 @@ class InterpDataFilter(object):
             staggered_data[tuple(s)] = data[tuple(s)]
 
         return staggered_data
+
+    @staticmethod
+    def __staggered_axis(data, axis, offset, chunk_size=1 << 22):
+        """Linear interpolation along a single axis without the interpolation mesh, computed in slabs of about
+        "chunk_size" elements. Each element is the weighted sum of its two grid neighbours with the cell index and
+        weight interpn derives from the shifted coordinate, in float64 and in the same order, so the result is
+        bit-identical to the general path (for finite data).
+
+        :param data:       Input N-dimensional array of data.
+        :param axis:       Axis of the shift.
+        :param offset:     Offset along "axis" (0 < abs("offset") <= 1).
+        :param chunk_size: Number of elements per slab.
+        :return:           Returns data interpolated to the offset grid. Off-grid values are copied from original data.
+        """
+        def along(start, stop):
+            s = [slice(None) for _ in range(0, len(data.shape))]
+            s[axis] = slice(start, stop)
+            return tuple(s)
+
+        staggered_data = np.empty(data.shape, dtype=np.result_type(data.dtype, np.float64))
+        length = data.shape[axis]
+        step = max(chunk_size // max(data.size // max(length, 1), 1), 1)
+
+        # Lower neighbour and normalised distance of every shifted coordinate, as interpn finds them
+        x = np.arange(length, dtype=np.float64) + offset
+        lower = np.clip(np.floor(x).astype(np.intp), 0, max(length - 2, 0))
+        y = x - lower
+        shape = [1 for _ in range(0, len(data.shape))]
+
+        # The shift moves one edge slice off the grid, it keeps the original data
+        inside = range(0, length - 1) if offset > 0 else range(1, length)
+        for start in range(inside.start, inside.stop, step):
+            stop = min(start + step, inside.stop)
+            shape[axis] = stop - start
+            weight = y[start:stop].reshape(shape)
+            staggered_data[along(start, stop)] = (np.take(data, lower[start:stop], axis=axis) * (1 - weight)
+                                                  + np.take(data, lower[start:stop] + 1, axis=axis) * weight)
+
+        edge = length - 1 if offset > 0 else 0
+        staggered_data[along(edge, edge + 1)] = data[along(edge, edge + 1)]
+
+        return staggered_data
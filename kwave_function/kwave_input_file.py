@@ -33,6 +33,7 @@
  * If not, see [http://www.gnu.org/licenses/](http://www.gnu.org/licenses/).
  *
 """
+import os
 import operator
 from enum import Enum
 from itertools import accumulate
@@ -55,7 +56,7 @@ class KWaveInputFile(object):
         CORNERS = 1
 
     def __init__(self, file_name, domain_shape, nt, spatial_delta, time_delta, c_ref=1500.0, pml_alpha=2, pml_size=20,
-                 reoder_output_data=True):
+                 reoder_output_data=True, chunks=None, compression=None, slab_size=1 << 20):
         """Constructor of k-Wave input file generator.
 
         :param file_name:          Name of the generated input file.
@@ -69,6 +70,10 @@ class KWaveInputFile(object):
         :param reoder_output_data: When set to True simulation data are reordered so that MATLAB semantics is preserved.
                                    Otherwise *ONLY* the simulation shape is changed to (Nz, Ny, Nx) and data ordering
                                    is preserved (spatial resolution, pml properties etc. are likewise reordered)
+        :param chunks:             HDF5 chunk shape (file order) of the global fields, True to let h5py pick one and
+                                   None for contiguous datasets.
+        :param compression:        HDF5 filter of the global fields (e.g. 'gzip'), implies chunking.
+        :param slab_size:          Number of elements per slab when global fields are streamed to the file.
         """
         self.file_name = file_name
         self.domain_shape = domain_shape
@@ -80,6 +85,9 @@ class KWaveInputFile(object):
         self.pml_alpha = self.__make_nd_tuple(pml_alpha, self.dims)
         self.pml_size = self.__make_nd_tuple(pml_size, self.dims)
         self.reoder_output_data = reoder_output_data
+        self.chunks = chunks
+        self.compression = compression
+        self.slab_size = slab_size
 
         self.file_handle = None
         self.file_state = None
@@ -110,11 +118,16 @@ class KWaveInputFile(object):
         """Write medium density [kg/m^3] into the opened file. The value has to be either scalar or N-dim array of same
         shape as the simulation domain.
 
-        :param rho0: Medium density N-dim array or scalar float value [kg/m^3].
+        :param rho0: Medium density N-dim array, iterable of slabs (see write_global_field_slabs) or scalar float
+                     value [kg/m^3].
         """
         self.__update_file_state(self.data_set_db.get_medium_properties())
 
-        if isinstance(rho0, (np.ndarray,)):
+        if self.__can_stream() and not np.isscalar(rho0):
+            if isinstance(rho0, (np.ndarray,)):
+                rho0 = self.__array_slabs(rho0)
+            self.__write_global_field_slabs(('rho0', 'rho0_sgx', 'rho0_sgy', 'rho0_sgz'), self.__density_slabs(rho0))
+        elif isinstance(rho0, (np.ndarray,)):
             self.__write_global_field('rho0', rho0)
             self.__write_global_field('rho0_sgx', InterpDataFilter.staggered(rho0, (0.5, 0.0, 0.0)))
             self.__write_global_field('rho0_sgy', InterpDataFilter.staggered(rho0, (0.0, 0.5, 0.0)))
@@ -129,12 +142,15 @@ class KWaveInputFile(object):
         """Write medium sound speed [m/s] into the opened file. The value has to be either scalar or N-dim array of the
         same shape as the simulation domain.
 
-        :param c0:    Medium sound speed N-dim array or scalar float value [m/s].
+        :param c0:    Medium sound speed N-dim array, iterable of slabs (see write_global_field_slabs) or scalar float
+                      value [m/s].
         :param c_ref: Reference sound-speed of the medium used to compute k-space correction coefficient [m/s].
         """
         self.__update_file_state(self.data_set_db.get_medium_properties())
 
-        if isinstance(c0, (np.ndarray,)):
+        if not isinstance(c0, (np.ndarray,)) and not np.isscalar(c0):
+            self.write_global_field_slabs('c0', c0)
+        elif isinstance(c0, (np.ndarray,)):
             self.__write_global_field('c0', c0)
         else:
             self.__write_scalar('c0', c0)
@@ -142,6 +158,50 @@ class KWaveInputFile(object):
         self.c_ref = c_ref or self.c_ref
         self.__write_scalar('c_ref', self.c_ref)
 
+    def write_global_field_slabs(self, name, slabs):
+        """Stream a global field to the opened file slab by slab, so the whole field is never held in memory. Slabs are
+        domain shaped except along the last axis, they follow each other along it and have to cover the domain (the
+        file order of k-Wave makes these contiguous blocks of the dataset). Needs a 3D domain with data reordering.
+
+        :param name:  Name of the dataset (e.g. 'c0').
+        :param slabs: Iterable of N-dim arrays.
+        """
+        if not self.__can_stream():
+            raise ValueError("Slab input needs a 3D domain with data reordering enabled!")
+
+        self.__write_global_field_slabs((name,), ((slab,) for slab in slabs))
+
+    def write_medium_from(self, template_name, link=False):
+        """Take the medium datasets from a template instead of computing them again. The template is a file written by
+        KWaveInputFile with only the medium properties set, for the same domain.
+
+        :param template_name: Name of the medium template file.
+        :param link:          Add external links to the template datasets instead of copying them. The input file is
+                              then only valid as long as the template exists.
+        """
+        self.__update_file_state(self.data_set_db.get_medium_properties())
+
+        with h5py.File(template_name, 'r') as template:
+            for name in template:
+                if name not in self.file_state:
+                    continue
+
+                item = self.file_state[name]
+                if tuple(reversed(template[name].shape)) not in ((1, 1, 1), KWaveInputFile.__make_nd_tuple(self.domain_shape, 3)):
+                    raise ValueError("Template must have same size as the simulation domain!")
+                item.is_set = True
+                item.size = tuple(reversed(template[name].shape))
+
+                if name in self.file_handle:
+                    del self.file_handle[name]
+                if link:
+                    self.file_handle[name] = h5py.ExternalLink(os.path.abspath(template_name), name)
+                else:
+                    template.copy(template[name], self.file_handle, name)
+
+            if 'c_ref' in template:
+                self.c_ref = float(template['c_ref'][()].ravel()[0])
+
     def write_medium_non_linear(self, b_on_a):
         """Write non-linear coefficient (B/A) into the opened file. The value has to be either scalar or N-dim array of the
         same shape as the simulation domain.
@@ -150,7 +210,9 @@ class KWaveInputFile(object):
         """
         self.__update_file_state(self.data_set_db.get_medium_properties())
 
-        if isinstance(b_on_a, (np.ndarray,)):
+        if not isinstance(b_on_a, (np.ndarray,)) and not np.isscalar(b_on_a):
+            self.write_global_field_slabs('BonA', b_on_a)
+        elif isinstance(b_on_a, (np.ndarray,)):
             self.__write_global_field('BonA', b_on_a)
         else:
             self.__write_scalar('BonA', b_on_a)
@@ -158,12 +220,14 @@ class KWaveInputFile(object):
     def write_medium_absorbing(self, alpha_coeff, alpha_power=1.0):
         """Write frequency dependent absorption properties of the medium.
 
-        :param alpha_coeff: Power law absorption coefficient (N-dim array or scalar float).
+        :param alpha_coeff: Power law absorption coefficient (N-dim array, iterable of slabs or scalar float).
         :param alpha_power: Power law absorption exponent (scalar float).
         """
         self.__update_file_state(self.data_set_db.get_medium_properties())
 
-        if isinstance(alpha_coeff, (np.ndarray,)):
+        if not isinstance(alpha_coeff, (np.ndarray,)) and not np.isscalar(alpha_coeff):
+            self.write_global_field_slabs('alpha_coeff', alpha_coeff)
+        elif isinstance(alpha_coeff, (np.ndarray,)):
             self.__write_global_field('alpha_coeff', alpha_coeff)
         else:
             self.__write_scalar('alpha_coeff', alpha_coeff)
@@ -429,7 +493,87 @@ class KWaveInputFile(object):
         if not KWaveInputFile.__is_shape_compatible(self.domain_shape, data.shape):
             raise ValueError("Global field must have same size as the simulation domain!")
 
-        self.__write_field(name, data)
+        if self.__can_stream():
+            self.__write_global_field_slabs((name,), ((slab,) for slab in self.__array_slabs(data)))
+        else:
+            self.__write_field(name, data)
+
+    def __can_stream(self):
+        return self.reoder_output_data and len(self.domain_shape) == 3
+
+    def __array_slabs(self, data):
+        if data.shape != tuple(self.domain_shape):
+            raise ValueError("Global field must have same size as the simulation domain!")
+
+        step = max(self.slab_size // max(data.shape[0] * data.shape[1], 1), 1)
+        for start in range(0, data.shape[2], step):
+            yield data[:, :, start:start + step]
+
+    @staticmethod
+    def __density_slabs(slabs):
+        # (rho0, rho0_sgx, rho0_sgy, rho0_sgz) per slab, rho0_sgz needs the first plane of the following slab
+        previous = None
+        for slab in slabs:
+            slab = np.asarray(slab)
+            if previous is not None:
+                yield KWaveInputFile.__stagger_slab(previous, slab[:, :, :1])
+            previous = slab
+
+        if previous is not None:
+            yield KWaveInputFile.__stagger_slab(previous, None)
+
+    @staticmethod
+    def __stagger_slab(slab, next_plane):
+        if next_plane is None:
+            sgz = InterpDataFilter.staggered(slab, (0.0, 0.0, 0.5))
+        else:
+            sgz = InterpDataFilter.staggered(np.concatenate((slab, next_plane), axis=2), (0.0, 0.0, 0.5))[:, :, :-1]
+
+        return (slab, InterpDataFilter.staggered(slab, (0.5, 0.0, 0.0)),
+                InterpDataFilter.staggered(slab, (0.0, 0.5, 0.0)), sgz)
+
+    def __write_global_field_slabs(self, names, slabs):
+        # Several datasets written side by side, slabs yields one domain ordered slab per name
+        data_sets = []
+        for name in names:
+            item = self.file_state.get(name)
+            if item is not None:
+                item.is_set = True
+                item.size = KWaveInputFile.__make_nd_tuple(tuple(self.domain_shape), 3)
+            data_sets.append(self.__create_global_data_set(name, item))
+
+        position = 0
+        for slab_tuple in slabs:
+            for data_set, slab in zip(data_sets, slab_tuple):
+                slab = np.asarray(slab)
+                if slab.shape[0:2] != tuple(self.domain_shape[0:2]):
+                    raise ValueError("Slabs must match the simulation domain except along the last axis!")
+                if data_set is not None:
+                    data_set[position:position + slab.shape[2]] = np.ascontiguousarray(self.__array_to_output_order(slab),
+                                                                                        dtype=data_set.dtype)
+            position += slab_tuple[0].shape[2]
+
+        if position != self.domain_shape[2]:
+            raise ValueError("Slabs must cover the simulation domain!")
+
+    def __create_global_data_set(self, name, item):
+        if item is None:
+            return None
+
+        shape = tuple(reversed(item.size))
+        dtype = (np.float32 if item.data_type == 'float' else np.uint64)
+        if name in self.file_handle:
+            data_set = self.file_handle[name]
+            if data_set.shape != shape:
+                raise ValueError("Dataset cannot change shape once created!")
+        else:
+            data_set = self.file_handle.create_dataset(name, shape, dtype=dtype, chunks=self.chunks,
+                                                       compression=self.compression)
+
+        KWaveInputFile.__create_string_attrib(data_set, 'data_type', item.data_type)
+        KWaveInputFile.__create_string_attrib(data_set, 'domain_type', item.domain_type)
+
+        return data_set
 
     def __write_data_set(self, data_set_name, data_set_item, data):
         if data.shape != data_set_item.size:
@@ -521,7 +665,7 @@ class KWaveInputFile(object):
 
     @staticmethod
     def __create_string_attrib(data_set, attr_name, string):
-        np_string = np.string_(string)
+        np_string = np.bytes_(string)
         tid = h5py.h5t.C_S1.copy()
         tid.set_size(len(string) + 1)
         data_set.attrs.create(attr_name, np_string, dtype=h5py.Datatype(tid))
@@ -49,14 +49,16 @@ class DomainSamplingType(Enum):
 class KWaveOutputFile(object):
     """Represents k-Wave output file."""
 
-    def __init__(self, file_name, reorder_data=True):
+    def __init__(self, file_name, reorder_data=True, start_sampling_time=0):
         """Constructor of k-Wave output file object.
 
-        :param file_name:    Name of the simulation output file.
-        :param reorder_data: Whether input file was created with data reordering enabled.
+        :param file_name:           Name of the simulation output file.
+        :param reorder_data:        Whether input file was created with data reordering enabled.
+        :param start_sampling_time: First time-step stored in the sensor series (set by KWaveBinaryDriver.run).
         """
         self.file_name = file_name
         self.reorder_data = reorder_data
+        self.start_sampling_time = start_sampling_time
         self.file_handle = None
 
     def open(self):
@@ -98,6 +100,27 @@ class KWaveOutputFile(object):
         self.file_handle[dataset_name].read_direct(data)
         return data
 
+    def read_pressure_at_sensor_chunks(self, sampling_type: SensorSamplingType, chunk_size):
+        """Read pressure at sensor points/indexes in blocks of at most chunk_size sensors, so only one block is held in
+        memory at a time.
+
+        :param sampling_type: One of reduction methods from SensorSamplingType enum.
+        :param chunk_size:    Number of sensor points per block.
+        :return:              Generator of (start, data) tuples, data holds the series or values of sensors
+                              start, start + 1, ... along its last axis. The buffer is reused between blocks.
+        """
+        dataset_name = 'p_{}'.format(sampling_type.value) if sampling_type != SensorSamplingType.RAW else 'p'
+        dataset = self.file_handle[dataset_name]
+        n_sensors = dataset.shape[-1]
+
+        data = None
+        for start in range(0, n_sensors, chunk_size):
+            stop = min(start + chunk_size, n_sensors)
+            if data is None or data.shape[-1] != stop - start:
+                data = np.zeros(dataset.shape[:-1] + (stop - start,), dtype=dataset.dtype)
+            dataset.read_direct(data, source_sel=np.s_[..., start:stop])
+            yield start, data
+
     def read_velocity_everywhere(self, sampling_type: DomainSamplingType):
         """Read velocity in each direction X,Y,Z at all point in the simulation domain.
 
@@ -138,6 +161,13 @@ class KWaveOutputFile(object):
         """
         return self.file_handle['Nt'][0], self.file_handle['dt'][0]
 
+    def read_sampling_time_steps(self):
+        """Time-step (counted from 0) of each sample of the RAW sensor series.
+
+        :return: Array of time-step indexes, one per sample along the time axis of the 'p' dataset.
+        """
+        return np.arange(self.start_sampling_time, self.start_sampling_time + self.file_handle['p'].shape[-2])
+
     def read_spatial_properties(self):
         """Read spatial properties (size and resolution) of the simulation grid
 
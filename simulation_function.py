@@ -1,24 +1,41 @@
 import os
+import inspect
+import shutil
+import tempfile
+import weakref
 import numpy as np
 import math
 import time
 import SimpleITK as sitk
+from collections import namedtuple
 
 from help_function.niiCook import niiCook
 from help_function import help_function as hlp
+from help_function.placement_scorer import placementScorer, placementScorerPool, scalpSearchSpace, cone_normals
+from help_function.surrogate import surrogateOptimizer
+from help_function.correlation_engine import fftPlacementEngine, orientation_lattice
+from help_function.run_cache import runCache
 
 from kwave_function.kwave_input_file import KWaveInputFile
 from kwave_function.kwave_output_file import KWaveOutputFile, DomainSamplingType, SensorSamplingType
 from kwave_function.kwave_bin_driver import KWaveBinaryDriver
 
+from concurrent.futures import Future, FIRST_COMPLETED, wait
 from scipy.optimize import differential_evolution
+from scipy.spatial import cKDTree
+from scipy.stats import qmc
+
+# scipy >= 1.9 can hand the whole population to the objective at once
+DE_VECTORIZED = 'vectorized' in inspect.signature(differential_evolution).parameters
 
 l2n = lambda l: np.array(l)
 n2l = lambda n: list(n)
 
-start = time.time()
 current_path = os.path.dirname(__file__)
 
+# Medium datasets of one skull and material set written once (get_medium_template), with the sound speed range
+mediumTemplate = namedtuple('mediumTemplate', ['path', 'key', 'c_min', 'c_max'])
+
 class makeSimulation():
 
     def __init__(self, path=False):
@@ -61,10 +78,55 @@ class makeSimulation():
 
         ####################################################################
         # Back propagation
-        self.PHASE = []
-        self.AMP = []
+        self.FIELD = None   # (n_targets, X, Y, Z) complex64 stack of BP_Amp*exp(i*BP_Phase)
+        self.field_count = 0    # targets already in FIELD (make_ROI fills the next slot)
         self.back_source = []
         self.optimizer_check = 0
+        self.roi_sensor = True  # record RAW pressure only at the ROI voxels (ROI is computed before the run)
+        self.ROI = None
+        self.sensor_idx = None  # (Ns, 3) voxel index of each recorded sensor, None for full domain recording
+        self.sensor_chunk = 8192    # sensors per block when streaming the RAW pressure from the output file
+        self.phase_estimator = 'peak'   # 'peak' (time of the maximum) or 'lockin' (Fourier coefficient at source_freq)
+        self.window_sampling = True     # simulate and record only between the earliest arrival and latest departure
+                                        # at the ROI; back.nii then holds the MAX over that window (False: whole run)
+        self.sampling_margin = 0.2      # relative slack on the latest departure
+        self.bp_workers = 1     # >1: per target back propagations of findOptimalPosition run as concurrent solvers
+        self.bp_threads = None  # solver threads per run (OMP_NUM_THREADS), None: all cores / bp_workers
+        self.bp_memory = None   # [bytes] address space limit of each solver process (Linux), None: no limit
+        self.solver_timeout = None  # [s] wall-clock limit of each solver run, None: no limit
+        self.cache_dir = None   # directory of the solver run cache (k-Wave output and BP maps), None: no cache
+        self.cache_size = 20e9  # [bytes] run cache size before the least recently used runs are evicted
+        self.runCache = None
+
+        ####################################################################
+        # Transducer voxel templates (shared by the optimizer and make_transducer)
+        self.normal_step = 0.005
+        self.template_cache_size = 1024
+        self.capCache = None
+
+        ####################################################################
+        # Optimizer
+        self.normal_angle = 20  # [deg] allowed angle between normal and direction to the target
+        self.vectorized = True  # score the whole DE population per call
+        self.workers = 1        # >1 evaluates each generation in a process pool with shared BP maps (spawned
+                                # workers, the calling script needs an `if __name__ == '__main__':` guard)
+        self.worker_threads = 1 # numba threads per worker process
+        self.score_cache_size = 100000  # placements whose score is memoised (integer centre, quantised normal)
+        self.prefilter = True   # reject placements hitting bone / head or leaving the grid before voxelising the cap
+        self.feasible_init = True       # seed DE with quasi-random feasible placements instead of a random box
+        self.optimizer = 'de'           # 'de', 'surrogate' (GP + expected improvement, best with 'scalp' space) or
+                                        # 'fft' (every centre for a lattice of normals, writes the score landscape)
+        self.surrogate_evals = 1000     # exact evaluations of the surrogate mode (median within 2 % of DE, see surrogateOptimizer)
+        self.fft_cone = 45              # [deg] lattice of normals around the skull-to-target direction ('fft')
+        self.fft_step = 10              # [deg] lattice spacing
+        self.fft_workers = -1           # scipy.fft threads
+        self.multires_levels = 1        # >1: optimise on maps 2**(levels-1) times coarser first, then refine
+        self.multires_shrink = 0.1      # half width of the refinement box relative to the full search box
+        self.multires_popsize = 10      # DE population (per parameter) and generations of the refinement levels,
+        self.multires_maxiter = 30      # which start from the optimum of the coarser level
+        self.search_space = 'box'       # 'box': ROI bounding box + normal, 'scalp': scalp direction, gap and tilt
+        self.scalp_cone = 180           # [deg] half angle of the scalp directions around the nearest skull direction
+        self.scalp_standoff = (0, 10)   # [mm] range of the gap between scalp and transducer rim
 
         ####################################################################
         # Path
@@ -78,6 +140,31 @@ class makeSimulation():
             except:
                 a=1
 
+        # Every solver run gets its own scratch directory for the k-Wave input and output files
+        self.scratch_dir = None     # parent of the scratch directories, None for the system temp directory
+        self.keep_scratch = False   # keep the scratch directory (and its files) after the run
+        self.link_medium = False    # input files link the medium datasets of the template instead of copying them
+        self.mediumTemplates = {}
+        self.template_dir = None
+
+    # Cropped CT domain (HU). Assigning a new domain drops the content key of the previous one, the array itself is
+    # never modified in place
+    @property
+    def skullCrop_arr(self):
+        return self._skullCrop_arr
+
+    @skullCrop_arr.setter
+    def skullCrop_arr(self, skullCrop_arr):
+        self._skullCrop_arr = skullCrop_arr
+        self._skull_key = None
+
+    # Content key of skullCrop_arr, hashed once per domain
+    def skull_key(self):
+
+        if self._skull_key is None:
+            self._skull_key = runCache.key(self.skullCrop_arr)
+        return self._skull_key
+
     def preprocessing(self, itk_image, target_pose):
 
         target_pose = np.multiply(target_pose, (-1, -1, 1)).astype(float)
@@ -106,7 +193,7 @@ class makeSimulation():
 
         self.domainCook = niiCook()
         self.domainCook.readITK(skullCrop_itk)
-        self.domainCook.saveITK(self.path+"\\skullCrop_itk.nii")
+        self.domainCook.saveITK(os.path.join(self.path, "skullCrop_itk.nii"))
 
         self.dx = dx
         self.grid_res = grid_res
@@ -114,6 +201,7 @@ class makeSimulation():
         self.skullCrop_arr = skullCrop_arr
         self.rawCrop_arr = skullCrop_arr.copy()
         self.skullCrop_itk = skullCrop_itk
+        self.ROI = None
         self.domain_shape = skullCrop_arr.shape
         self.target_idx = np.array(skullCrop_itk.TransformPhysicalPointToIndex(target_pose)).astype(int)
         self.p0 = np.zeros(self.skullCrop_arr.shape)
@@ -160,7 +248,7 @@ class makeSimulation():
         # Save
         self.domainCook = niiCook()
         self.domainCook.readITK(skullCrop_itk)
-        self.domainCook.saveITK(self.path+"\\skullCrop_rotate_itk.nii")
+        self.domainCook.saveITK(os.path.join(self.path, "skullCrop_rotate_itk.nii"))
 
         self.dx = dx
         self.grid_res = grid_res
@@ -168,6 +256,7 @@ class makeSimulation():
         self.skullCrop_arr = skullCrop_arr
         self.rawCrop_arr = skullCrop_arr.copy()
         self.skullCrop_itk = skullCrop_itk
+        self.ROI = None
         self.domain_shape = skullCrop_arr.shape
         self.target_idx = np.array(skullCrop_itk.TransformPhysicalPointToIndex(target_pose)).astype(int)
         self.p0 = np.zeros(self.skullCrop_arr.shape)
@@ -196,6 +285,7 @@ class makeSimulation():
         self.skullCrop_arr = domainCook.array
         self.rawCrop_arr = domainCook.array.copy()
         self.skullCrop_itk = domainCook.itkImage
+        self.ROI = None
         self.domain_shape = domainCook.dimension
         self.domainCook = domainCook
         self.p0 = np.zeros(self.skullCrop_arr.shape)
@@ -220,8 +310,8 @@ class makeSimulation():
         Tcenter = self.tran_idx
         Tnormal =  self.normal
 
-        Spos = hlp.make_transducer(ROC, width, dx, Tcenter, Tnormal)
-        Spos = Spos.astype(int)
+        offsets = self.get_cap_cache().lookup(Tnormal)
+        Spos = offsets + Tcenter[::-1]
 
         if np.any(Spos[:,0] >= self.skullCrop_arr.shape[0])\
                 or np.any(Spos[:,1] >= self.skullCrop_arr.shape[1])\
@@ -237,28 +327,18 @@ class makeSimulation():
             self.Spos = Spos
             self.p0 = p0
 
-            self.trans_itk = self.domainCook.makeITK(self.p0*2000, self.path+"\\transducer.nii")
+            self.trans_itk = self.domainCook.makeITK(self.p0*2000, os.path.join(self.path, "transducer.nii"))
 
-    def run_simulation(self):
-        start = time.time()
-        print(" ")
-        print(" ")
-        print("################################")
-        print("Start simulation")
-        print("################################")
-        print(" ")
-        print(" ")
-        print("####  Simulation specs  ####")
-        print("Iso Voxel size: " + str(self.dx))
-
-        print("CFL: " + str(self.CFL))
-        print("end time: " + str(self.end_time))
-        print("PPW: " + str(self.points_per_wavelength))
+    def get_cap_cache(self):
+        # Templates depend on the transducer spec and grid, rebuild the cache when any of them changed
+        if self.capCache is None or not self.capCache.matches(self.ROC, self.width, self.dx):
+            self.capCache = hlp.capTemplateCache(self.ROC, self.width, self.dx,
+                                                 normal_step=self.normal_step, maxsize=self.template_cache_size)
+        return self.capCache
 
-        ####################################################################
-        # Source properties
-        amplitude = self.amplitude       # source pressure [Pa]
-        source_freq = self.source_freq     # frequency [Hz]
+    # Medium of the forward (back=False) or attenuation free back propagation runs. It is computed and written to a
+    # template file once per skull and material set, input files then take the medium datasets from the template
+    def get_medium_template(self, back=False):
 
         ####################################################################
         # Material properties
@@ -272,38 +352,14 @@ class makeSimulation():
         a_bone_max = self.a_bone_max  # [Np/MHz/m]
         alpha_power = self.alpha_power
 
-        ####################################################################
-        # Grid properties
-        dx = self.dx
-        dy = dx
-        dz = dx
-        grid_res = self.grid_res
-
-        ####################################################################
-        # skull array
-        skullCrop_arr = self.skullCrop_arr
-
-        ####################################################################
-        # Transducer
-        p0 = self.p0
-
-
-        ####################################################################
-        # Time step
-        CFL      = self.CFL
-        end_time = self.end_time
-        dt       = CFL * grid_res[0] / c_water
-        steps    = int(end_time / dt)
-
-
-        input_filename  ='kwave_in.h5'
-        output_filename ='kwave_out.h5'
+        key = runCache.key(self.skull_key(), c_water, d_water, a_water, c_bone, d_bone, a_bone_min, a_bone_max,
+                           alpha_power, back)
+        if key in self.mediumTemplates and os.path.isfile(self.mediumTemplates[key].path):
+            return self.mediumTemplates[key]
 
         ####################################################################
         # Skull process
-
-        grid_size = skullCrop_arr.shape
-        skullCrop_arr[skullCrop_arr > 3000] = 3000
+        skullCrop_arr = np.minimum(self.skullCrop_arr, 3000)   # copy, self.skullCrop_arr keeps the HU values
         skullCrop_arr[skullCrop_arr < 250 ] = 0
 
         if np.all(skullCrop_arr==0):
@@ -323,6 +379,11 @@ class makeSimulation():
         ct_att          = a_bone_min + (a_bone_max-a_bone_min)*np.power(PI, 0.5)
         ct_att[PI==1]   = a_water
 
+        ###################################################################
+        # For back propagation kill the attenuation
+        if back:
+            ct_att[:,:,:] = 0
+
         ###################################################################
         # assign skull properties depend on HU value  - Ref. Multi resolution, Yoon et al, 2019
         # PI = skullCrop_arr/np.max(skullCrop_arr)
@@ -338,6 +399,92 @@ class makeSimulation():
 
         alpha_coeff = hlp.neper2db(alpha_coeff_np/pow(2*np.pi*1e6, alpha_power), alpha_power) #[Np/MHz/m] -> [Np/(rad/s)^y/m] -> [dB/MHz/cm]
 
+        ####################################################################
+        # Template file, removed with this object unless keep_scratch is set
+        if self.template_dir is None:
+            self.template_dir = self.make_scratch()
+            if not self.keep_scratch:
+                weakref.finalize(self, shutil.rmtree, self.template_dir, True)
+
+        path = os.path.join(self.template_dir, 'medium_{}.h5'.format(key[:16]))
+        dt = self.CFL * self.grid_res[0] / c_water
+        with KWaveInputFile(path, self.skullCrop_arr.shape, 0, self.grid_res, dt) as file:
+            file.write_medium_sound_speed(sound_speed)
+            file.write_medium_density(density)
+            file.write_medium_absorbing(alpha_coeff, alpha_power)
+
+        template = mediumTemplate(path, key, np.min(sound_speed), np.max(sound_speed))
+        self.mediumTemplates[key] = template
+
+        return template
+
+    def get_run_cache(self):
+        # Solver runs keyed by their content, None when caching is off
+        if self.cache_dir is None:
+            return None
+        if self.runCache is None or self.runCache.directory != self.cache_dir:
+            self.runCache = runCache(self.cache_dir, self.cache_size)
+        self.runCache.max_bytes = self.cache_size
+        return self.runCache
+
+    def run_simulation(self):
+
+        scratch = self.make_scratch()
+        try:
+            return self.__run_simulation(scratch)
+        finally:
+            self.clean_scratch(scratch)
+
+    def __run_simulation(self, scratch):
+        start = time.time()
+        print(" ")
+        print(" ")
+        print("################################")
+        print("Start simulation")
+        print("################################")
+        print(" ")
+        print(" ")
+        print("####  Simulation specs  ####")
+        print("Iso Voxel size: " + str(self.dx))
+
+        print("CFL: " + str(self.CFL))
+        print("end time: " + str(self.end_time))
+        print("PPW: " + str(self.points_per_wavelength))
+
+        ####################################################################
+        # Source properties
+        amplitude = self.amplitude       # source pressure [Pa]
+        source_freq = self.source_freq     # frequency [Hz]
+
+        ####################################################################
+        # Material properties
+        c_water = self.c_water      # [m/s]
+
+        ####################################################################
+        # Grid properties
+        grid_res = self.grid_res
+        grid_size = self.skullCrop_arr.shape
+
+        ####################################################################
+        # Transducer
+        p0 = self.p0
+
+
+        ####################################################################
+        # Time step
+        CFL      = self.CFL
+        end_time = self.end_time
+        dt       = CFL * grid_res[0] / c_water
+        steps    = int(end_time / dt)
+
+
+        input_filename  = os.path.join(scratch, 'kwave_in.h5')
+        output_filename = os.path.join(scratch, 'kwave_out.h5')
+
+        ####################################################################
+        # Medium of this skull
+        medium = self.get_medium_template()
+
         ####################################################################
         # Define simulation input and output files
         print("## k-wave core input function")
@@ -353,9 +500,7 @@ class makeSimulation():
         ####################################################################
         # Open the simulation input file and fill it as usual
         with input_file as file:
-            file.write_medium_sound_speed(sound_speed)
-            file.write_medium_density(density)
-            file.write_medium_absorbing(alpha_coeff, alpha_power)
+            file.write_medium_from(medium.path, link=self.link_medium)
             file.write_source_input_p(file.domain_mask_to_index(p0), source_signal, KWaveInputFile.SourceMode.ADDITIVE, c_water)
 
             sensor_mask = np.ones(grid_size)
@@ -374,7 +519,7 @@ class makeSimulation():
 
 
         # Execute the solver with specified input and output files
-        driver.run(input_file, output_file)
+        driver.run(input_file, output_file, timeout=self.solver_timeout)
         print("## Calculation time :", time.time() - start)
 
 
@@ -393,11 +538,72 @@ class makeSimulation():
                 self.p_raw = p_raw
 
             self.p_max = p_max
-            result_itk = self.domainCook.makeITK(p_max, self.path+"\\forward.nii")
+            result_itk = self.domainCook.makeITK(p_max, os.path.join(self.path, "forward.nii"))
             self.result_itk = result_itk
 
         return result_itk
 
+    # Physical point (findOptimalPosition source) as the back propagation source
+    def set_backpropagation_source(self, source):
+
+        point = self.skullCrop_itk.TransformPhysicalPointToIndex(source)
+        self.back_source.append(point)
+        self.p0 = np.zeros(self.domain_shape)
+        self.p0[int(point[0]), int(point[1]), int(point[2])] = 1
+
+    # Per target back propagations on bp_workers concurrent solver processes. The input file of the next target is
+    # written as soon as a solver is free while the others keep running, and each output is read into FIELD when its
+    # solver is done, so FIELD follows the completion order of the targets. The first failed or timed out run cancels
+    # the solvers still running (killing their process groups) before its error is raised
+    def parallel_backpropagation(self, source):
+
+        threads = self.bp_threads
+        if threads is None:
+            threads = max((os.cpu_count() or 1) // self.bp_workers, 1)
+
+        scratches = []
+        runs = {}
+        target = 0
+        try:
+            while target < source.shape[0] or runs:
+                while target < source.shape[0] and len(runs) < self.bp_workers:
+                    self.set_backpropagation_source(source[target,:])
+                    target += 1
+                    scratch = self.make_scratch()
+                    scratches.append(scratch)
+                    driver, input_file, output_file, key = self.prepare_backpropagation(scratch, threads)
+                    runs[self.start_backpropagation(driver, input_file, output_file)] = (scratch, input_file,
+                                                                                         output_file, key)
+
+                done, _ = wait(runs, return_when=FIRST_COMPLETED)
+                for run in done:
+                    scratch, input_file, output_file, key = runs.pop(run)
+                    run.result()
+                    if input_file is not None:
+                        self.store_backpropagation(output_file, key)
+                    self.read_backpropagation(output_file, key)
+                    self.make_ROI()
+                    self.clean_scratch(scratch)
+
+                    del self.BP_Phase, self.BP_Amp, self.BP_step
+        finally:
+            for run in runs:
+                run.cancel()
+            for scratch in scratches:
+                self.clean_scratch(scratch)
+
+    # Unique scratch directory of one solver run, so runs on the same host do not overwrite each other's files
+    def make_scratch(self):
+
+        if self.scratch_dir is not None:
+            os.makedirs(self.scratch_dir, exist_ok=True)
+        return tempfile.mkdtemp(prefix='kwave_', dir=self.scratch_dir)
+
+    def clean_scratch(self, scratch):
+
+        if not self.keep_scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
     # Convert target as back propagation source
     def back_propagation_source(self):
         ####################################################################
@@ -410,7 +616,29 @@ class makeSimulation():
     # Run back propagation
     def run_backpropagation(self):
 
+        scratch = self.make_scratch()
+        try:
+            return self.__run_backpropagation(scratch)
+        finally:
+            self.clean_scratch(scratch)
+
+    def __run_backpropagation(self, scratch):
+
         start = time.time()
+        driver, input_file, output_file, key = self.prepare_backpropagation(scratch, self.bp_threads)
+
+        # Execute the solver with specified input and output files
+        self.solve_backpropagation(driver, input_file, output_file, key)
+        print(" ")
+        print(" ")
+        print("## Calculation time of Back propagation :", time.time() - start)
+
+        return self.read_backpropagation(output_file, key)
+
+    # Medium, source and sensor of one back propagation run written to the scratch directory, the solver is not run.
+    # With a run cache the input file is skipped (None) when the cache already holds the run
+    def prepare_backpropagation(self, scratch, threads=None):
+
         print(" ")
         print(" ")
         print("################################")
@@ -425,8 +653,8 @@ class makeSimulation():
         print("end time: " + str(self.end_time))
         print("PPW: " + str(self.points_per_wavelength))
 
-        input_filename  ='kwave_in.h5'
-        output_filename ='kwave_out.h5'
+        input_filename  = os.path.join(scratch, 'kwave_in.h5')
+        output_filename = os.path.join(scratch, 'kwave_out.h5')
 
         ####################################################################
         # Source properties
@@ -436,25 +664,11 @@ class makeSimulation():
         ####################################################################
         # Material properties
         c_water = self.c_water      # [m/s]
-        d_water = self.d_water      # [kg/m^3]
-        a_water = self.a_water   # [Np/MHz/cm]
-
-        c_bone = self.c_bone       # [m/s]    # 2800 or 3100 m/s
-        d_bone = self.d_bone       # [kg/m^3]
-        a_bone_min = self.a_bone_min   # [Np/MHz/cm]
-        a_bone_max = self.a_bone_max  # [Np/MHz/cm]
-        alpha_power = self.alpha_power
 
         ####################################################################
         # Grid properties
-        dx = self.dx
-        dy = dx
-        dz = dx
         grid_res = self.grid_res
-
-        ####################################################################
-        # skull array
-        skullCrop_arr = self.skullCrop_arr
+        grid_size = self.skullCrop_arr.shape
 
         ####################################################################
         # Time step
@@ -472,42 +686,27 @@ class makeSimulation():
         self.back_source.append(p0_idx)
 
 
-        # normalize HU value
-        grid_size = skullCrop_arr.shape
-        skullCrop_arr[skullCrop_arr > 3000] = 3000
-        skullCrop_arr[skullCrop_arr < 250 ] = 0
-
-
         ####################################################################
-        # assign skull properties depend on HU value  - Ref. Numerical evaluation, Muler et al, 2017
-        print("Skull_max", np.max(skullCrop_arr))
-        PI = 1 - (skullCrop_arr/np.max(skullCrop_arr))
-        ct_sound_speed = c_water*PI + c_bone*(1-PI)
-        ct_density  = d_water*PI + d_bone*(1-PI)
-
-        ct_att          = a_bone_min + (a_bone_max-a_bone_min)*np.power(PI, 0.5)
-        ct_att[PI==1]   = a_water
-
-        ###################################################################
-        # For back propagation kill the attenuation
-        ct_att[:,:,:] = 0
-
-        ###################################################################
-        # assign skull properties depend on HU value  - Ref. Multi resolution, Yoon et al, 2019
-        # PI = skullCrop_arr/np.max(skullCrop_arr)
-        # ct_sound_speed = c_water + (2800 - c_water)*PI
-        # ct_density     = d_water + (d_bone - d_water)*PI
-        # ct_att         = 0 + (20 - 0)*PI
-
+        # Attenuation free medium of this skull
+        medium = self.get_medium_template(back=True)
 
         ####################################################################
-        # Assign material properties
-        sound_speed     = ct_sound_speed
-        density         = ct_density
-        alpha_coeff_np  = ct_att
-
+        # Sensor mask, only the ROI voxels are used by make_ROI and sensor rows follow the index order of the file
+        if self.recording and self.roi_sensor:
+            if self.ROI is None:
+                self.make_ROI_mask()
+            sensor_mask = self.ROI
+            self.sensor_idx = np.argwhere(sensor_mask.transpose(2, 1, 0))[:, ::-1]
+        else:
+            sensor_mask = np.ones(grid_size)
+            self.sensor_idx = None
 
-        alpha_coeff = hlp.neper2db(alpha_coeff_np/pow(2*np.pi*1e6, alpha_power), alpha_power) #[Np/MHz/m] -> [Np/(rad/s)^y/m] -> [dB/MHz/cm]
+        # Sample only while the pulse crosses the ROI. The solver start (-s) and the shortened run apply to every
+        # sampled quantity alike, so the domain MAX map covers the same window as the sensor series
+        start_step = 0
+        if self.recording and self.sensor_idx is not None and self.window_sampling:
+            start_step, steps = self.sampling_window(p0, medium.c_min, medium.c_max, dt, steps)
+            print("Sampling window: steps", start_step, "-", steps)
 
         ####################################################################
         # Define simulation input and output files
@@ -525,76 +724,178 @@ class makeSimulation():
         source_signal = amplitude * np.sin((2*math.pi)*source_freq*np.arange(0.0, steps*dt, dt))
         source_signal[single_pulse_step:] = 0
 
-        ####################################################################
-        # Open the simulation input file and fill it as usual
-        with input_file as file:
-            file.write_medium_sound_speed(sound_speed)
-            file.write_medium_density(density)
-            file.write_medium_absorbing(alpha_coeff, alpha_power)
-            file.write_source_input_p(file.domain_mask_to_index(p0), source_signal, KWaveInputFile.SourceMode.ADDITIVE, c_water)
-
-            sensor_mask = np.ones(grid_size)
-            file.write_sensor_mask_index(file.domain_mask_to_index(sensor_mask))
-
         # Create k-Wave solver driver, which will call C++/CUDA k-Wave binary.
         # It is usually necessary to specify path to the binary: "binary_path=..."
-        driver = KWaveBinaryDriver()
+        driver = KWaveBinaryDriver(start_sampling_time=start_step, threads=threads, memory_limit=self.bp_memory)
 
 
-        # Specify which data should be sampled during the simulation (final pressure in the domain and
+        # Specify which data should be sampled during the simulation (maximum pressure in the domain and
         # RAW pressure at the sensor mask
         driver.store_pressure_everywhere([DomainSamplingType.MAX])
         if self.recording:
             driver.store_pressure_at_sensor([SensorSamplingType.RAW])
 
+        ####################################################################
+        # Run cache, the key covers everything the solver output depends on
+        key = None
+        cache = self.get_run_cache()
+        if cache is not None:
+            key = runCache.key(medium.key, np.flatnonzero(p0), source_signal, c_water, np.flatnonzero(sensor_mask),
+                               grid_size, grid_res, dt, steps, start_step, driver.sampling_list,
+                               os.path.basename(driver.binary_path))
+            cached = cache.lookup(key, 'kwave_out.h5')
+            if cached is not None or (self.recording and cache.lookup(key, self.maps_name()) is not None):
+                print("## Back propagation run found in the cache")
+                if cached is not None:
+                    output_file.file_name = cached
+                output_file.start_sampling_time = start_step
+                return driver, None, output_file, key
 
-        # Execute the solver with specified input and output files
-        driver.run(input_file, output_file)
-        print(" ")
-        print(" ")
-        print("## Calculation time of Back propagation :", time.time() - start)
+        ####################################################################
+        # Open the simulation input file and fill it as usual
+        with input_file as file:
+            file.write_medium_from(medium.path, link=self.link_medium)
+            file.write_source_input_p(file.domain_mask_to_index(p0), source_signal, KWaveInputFile.SourceMode.ADDITIVE, c_water)
+            file.write_sensor_mask_index(file.domain_mask_to_index(sensor_mask))
 
+        return driver, input_file, output_file, key
 
-        #Open the output file and generate plots from the results
-        with output_file as file:
-            if self.recording:
-                p_raw_raw = file.read_pressure_at_sensor(SensorSamplingType.RAW)
-                p_raw = np.squeeze(p_raw_raw).transpose([1,0])
+    # Solver run of a prepared back propagation, the output is moved into the run cache when there is one
+    def solve_backpropagation(self, driver, input_file, output_file, key):
 
-                del p_raw_raw
+        if input_file is None:
+            return
 
-                time_step = p_raw.shape[1]
-                #p_raw = np.flip(p_raw,axis=0)
-                p_raw = np.ravel(p_raw)
-                p_raw = np.reshape(p_raw, (self.domain_shape[2], self.domain_shape[1], self.domain_shape[0], time_step))
-                p_raw = p_raw.transpose([2, 1, 0, 3])
-                self.p_raw = p_raw
-                self.p_max = np.max(p_raw, axis=3)
+        driver.run(input_file, output_file, timeout=self.solver_timeout)
+        self.store_backpropagation(output_file, key)
 
+    # Solver of a prepared back propagation started in the background, its KWaveRun future (a finished future when
+    # the run cache already holds the run)
+    def start_backpropagation(self, driver, input_file, output_file):
 
-            else:
-                p_max = file.read_pressure_everywhere(DomainSamplingType.MAX)
-                self.p_max = p_max
+        if input_file is None:
+            run = Future()
+            run.set_result(output_file)
+            return run
+
+        return driver.run_async(input_file, output_file, timeout=self.solver_timeout, echo=True)
+
+    def store_backpropagation(self, output_file, key):
+
+        if key is not None:
+            output_file.file_name = self.get_run_cache().store(key, 'kwave_out.h5', output_file.file_name)
 
-            resultCook = niiCook()
-            resultCook.readITK(self.skullCrop_itk)
-            result_itk = resultCook.makeITK(self.p_max, self.path+"\\back.nii")
+    def maps_name(self):
+        return 'BP_{}.npz'.format(self.phase_estimator)
 
-        del output_file
+    # Read the output of a finished back propagation run: BP maps (recording) and the maximum pressure. Cached maps
+    # are loaded instead of reading the output, new ones are added to the cache
+    def read_backpropagation(self, output_file, key=None):
+
+        cache = self.get_run_cache() if key is not None else None
+        maps = None
+        if self.recording and cache is not None:
+            maps = cache.lookup(key, self.maps_name())
+
+        if maps is not None:
+            with np.load(maps) as data:
+                self.BP_Phase, self.BP_Amp, self.BP_step, self.p_max = (data[name] for name in
+                                                                        ('BP_Phase', 'BP_Amp', 'BP_step', 'p_max'))
+
+        else:
+            #Open the output file and generate plots from the results
+            with output_file as file:
+                if self.recording:
+                    self.read_BP(file)
+                    if self.sensor_idx is None:
+                        # Every voxel is a sensor, the peak amplitude is the maximum pressure
+                        self.p_max = self.BP_Amp
+                    else:
+                        self.p_max = file.read_pressure_everywhere(DomainSamplingType.MAX)
+
+                else:
+                    p_max = file.read_pressure_everywhere(DomainSamplingType.MAX)
+                    self.p_max = p_max
+
+            if self.recording and cache is not None:
+                cache.store(key, self.maps_name(), arrays=dict(BP_Phase=self.BP_Phase, BP_Amp=self.BP_Amp,
+                                                               BP_step=self.BP_step, p_max=self.p_max))
+
+        resultCook = niiCook()
+        resultCook.readITK(self.skullCrop_itk)
+        result_itk = resultCook.makeITK(self.p_max, os.path.join(self.path, "back.nii"))
 
         return result_itk
 
-    # Set ROI and calculate Amp and Phase
-    def make_ROI(self, plane = False):
+    # Stream the RAW sensor pressure into the BP_Phase/BP_Amp/BP_step maps one block of sensors at a time, so the
+    # time history of the whole sensor mask is never held in memory. phase_estimator picks the per block kernel
+    def read_BP(self, file):
+
+        shape = self.domain_shape
+        period = 1 / self.source_freq
+
+        BP_Phase = np.zeros(shape)
+        BP_Amp = np.zeros(shape)
+        BP_step = np.zeros(shape)
+
+        if self.phase_estimator == 'lockin':
+            estimator = hlp.make_ROI_lockin_chunk
+        elif self.phase_estimator == 'peak':
+            estimator = hlp.make_ROI_chunk
+        else:
+            raise ValueError("phase_estimator has to be 'peak' or 'lockin'")
+
+        # Sample n is taken at the end of time-step n
+        times = (file.read_sampling_time_steps() + 1) * self.dt
+        for start, p_chunk in file.read_pressure_at_sensor_chunks(SensorSamplingType.RAW, self.sensor_chunk):
+            # (1, Nt, Nc) block, column s is sensor start + s
+            p_chunk = p_chunk[0]
+
+            stop = start + p_chunk.shape[1]
+            if self.sensor_idx is None:
+                # Full domain recording, sensors follow the (z, y, x) file order
+                voxel_idx = np.stack(np.unravel_index(np.arange(start, stop), shape[::-1])[::-1], axis=1)
+            else:
+                voxel_idx = self.sensor_idx[start:stop]
+
+            estimator(voxel_idx.astype(np.int64), p_chunk, times, BP_Phase, BP_Amp, BP_step, period)
+
+        self.BP_Phase = BP_Phase
+        self.BP_Amp = BP_Amp
+        self.BP_step = BP_step
+
+    # Time steps in which the back propagated pulse can be at the sensors: straight paths at the fastest sound speed
+    # bound the earliest arrival, the slowest speed plus one pulse length the latest departure (sampling_margin
+    # leaves room for longer refracted paths)
+    def sampling_window(self, p0, c_min, c_max, dt, steps):
+
+        period = 1 / self.source_freq
+        sources = np.argwhere(p0 == 1)
+        if self.sensor_idx.shape[0] == 0 or sources.shape[0] == 0:
+            return 0, steps
+
+        d_min = np.inf
+        d_max = 0
+        for source in sources:
+            d = np.linalg.norm(self.sensor_idx - source, axis=1) * self.dx
+            d_min = min(d_min, d.min())
+            d_max = max(d_max, d.max())
+
+        first = int(np.floor(d_min / c_max / dt)) - 1
+        last = int(np.ceil((d_max / c_min * (1 + self.sampling_margin) + period) / dt)) + 1
+
+        # The solver needs at least one sampled step
+        last = min(last, steps)
+        return min(max(first, 0), last - 1), last
+
+    # ROI shell around the target outside the head, needed before the back propagation run to set the sensor mask
+    def make_ROI_mask(self, plane = False):
 
         print("## Calculate ROI")
 
         focal_length = self.focal_length
         skull_arr = self.skullCrop_arr
         dx = self.dx
-        dt = self.dt
-        source_freq = self.source_freq
-        p_raw = self.p_raw
 
 
         headCook = niiCook()
@@ -645,84 +946,101 @@ class makeSimulation():
         ROI_idx = np.array(np.where(ROI == 1))
         ROI_idx = ROI_idx.transpose()
 
-        times = np.linspace(1, np.int(p_raw.shape[3]), np.int(p_raw.shape[3]), endpoint=True) * dt
-        period = 1 / source_freq
+        self.initial_idx = initial_idx
+        self.head = head
+        self.ROI = ROI
+        self.ROI_plane = plane
+        self.ROI_idx = ROI_idx
 
-        BP_Phase = np.zeros(shape)
-        BP_Amp = np.zeros(shape)
-        BP_step = np.zeros(shape)
+        return ROI
 
-        BP_Phase, BP_Amp, BP_step = hlp.make_ROI_fast(ROI_idx, p_raw, times, BP_Phase, BP_Amp, BP_step,period)
+    # Set ROI and calculate Amp and Phase
+    def make_ROI(self, plane = False):
+
+        if self.ROI is None or self.ROI_plane != plane:
+            self.make_ROI_mask(plane)
+
+        # The recorded mask may be larger than a plane cut ROI
+        BP_Phase = self.BP_Phase*self.ROI
+        BP_Amp = self.BP_Amp*self.ROI
 
         BP_Amp = 100*BP_Amp/BP_Amp.max()
         #BP_Amp = BP_Amp+BP_step
 
-        self.domainCook.makeITK(BP_Phase, self.path+"\\BP_Phase.nii")
-        self.domainCook.makeITK(BP_Amp, self.path+"\\BP_Amp.nii")
+        self.domainCook.makeITK(BP_Phase, os.path.join(self.path, "BP_Phase.nii"))
+        self.domainCook.makeITK(BP_Amp, os.path.join(self.path, "BP_Amp.nii"))
 
-        self.initial_idx = initial_idx
-        self.ROI = ROI
-        self.ROI_idx = ROI_idx
-        self.PHASE.append(BP_Phase)
-        self.AMP.append(BP_Amp)
+        if self.FIELD is None:
+            self.allocate_field(1)
+        if self.field_count == self.FIELD.shape[0]:
+            raise ValueError("FIELD holds %d targets already, allocate_field first" % self.field_count)
 
-    # Set ROI and calculate Amp/Phase
-    def calculateScore(self, Input_data):
+        hlp.make_field(BP_Phase, BP_Amp, self.FIELD[self.field_count])
+        self.field_count += 1
 
-        Input_data = l2n(Input_data)
+    # Field stack for n_targets back propagations, allocated once so that adding a target copies nothing
+    def allocate_field(self, n_targets):
 
-        TCenter_normalized = Input_data[:3]
-        Tnormal = Input_data[3:]
-        Tnormal = Tnormal/np.linalg.norm(Tnormal)
+        self.FIELD = np.empty((n_targets,) + self.skullCrop_arr.shape, dtype=np.complex64)
+        self.field_count = 0
 
-        ROI_idx = self.ROI_idx
-        TCenter = TCenter_normalized.copy()
+    # Map optimizer parameters (normalized centre, normal) to transducer centre index and unit normal
+    def decode_placement(self, Input_data):
 
-        x_range = l2n([ROI_idx[:, 0].min(), ROI_idx[:, 0].max()])
-        y_range = l2n([ROI_idx[:, 1].min(), ROI_idx[:, 1].max()])
-        z_range = l2n([ROI_idx[:, 2].min(), ROI_idx[:, 2].max()])
+        return self.scorer.decode(Input_data)
 
-        TCenter[0] =  TCenter_normalized[0]*(x_range.max()- x_range.min()) + x_range.min()
-        TCenter[1] =  TCenter_normalized[1]*(y_range.max()- y_range.min()) + y_range.min()
-        TCenter[2] =  TCenter_normalized[2]*(z_range.max()- z_range.min()) + z_range.min()
+    def archive_placement(self, TCenter, Tnormal, score):
 
-        TCenter = TCenter.astype(int)
+        if self.optimizer_check==0:
+            print("Optimizer enter the orbit")
+            self.optimizer_check = 1
 
-        ## Check Normal vector
+        TCenter = TCenter*self.level_factor
+        point = self.skullCrop_itk.TransformIndexToPhysicalPoint((int(TCenter[0]), int(TCenter[1]), int(TCenter[2])))
+        point = l2n(point)*l2n([-1,-1,1])
 
-        angle = []
-        for i in range(len(self.back_source)):
-            back_target_idx = self.back_source[i]
-            standard_vector = l2n(back_target_idx) - l2n(TCenter)
+        final_data = np.zeros(7)
+        final_data[:3] = point
+        final_data[3:6] = Tnormal
+        final_data[-1] = score
 
-            standard_vector = standard_vector / np.linalg.norm(standard_vector)
-            dot_product = np.dot(Tnormal, standard_vector)
-            angle.append(np.abs(np.rad2deg(np.arccos(dot_product))))
+        self.gather_point.append(final_data)
 
-        if angle[0]>20:
-            score = 0
-            self.restart = self.restart + 1
-            return score
+    # Merge scored candidates into the evaluation archive
+    def record_scores(self, score, TCenter, Tnormal, valid):
 
-        score, Spos = hlp.score_fast(TCenter, Tnormal, self.PHASE, self.AMP, self.skullCrop_arr, self.width, self.ROC, self.dx)
-        self.gather_score.append(score)
-        self.restart  = self.restart+1
+        self.restart = self.restart + score.shape[0]
+        self.gather_score.extend(score[valid])
 
-        if score != 0:
+        for i in np.flatnonzero(score):
+            self.archive_placement(TCenter[i], Tnormal[i], score[i])
 
-            if self.optimizer_check==0:
-                print("Optimizer enter the orbit")
-                self.optimizer_check = 1
+    # Set ROI and calculate Amp/Phase
+    def calculateScore(self, Input_data):
 
-            point = self.skullCrop_itk.TransformIndexToPhysicalPoint((int(TCenter[0]), int(TCenter[1]), int(TCenter[2])))
-            point = l2n(point)*l2n([-1,-1,1])
+        return self.calculateScoreBatch(l2n(Input_data))[0]
 
-            final_data = np.zeros(7)
-            final_data[:3] = point
-            final_data[3:6] = Tnormal
-            final_data[-1] = score
+    # Score the whole population at once, Input_data is (D, S) as given by DE in vectorized mode
+    def calculateScoreBatch(self, Input_data):
+
+        Input_data = l2n(Input_data)
+        Input_data = Input_data.reshape((Input_data.shape[0], -1)).T
 
-            self.gather_point.append(final_data)
+        score, TCenter, Tnormal, valid = self.scorer.evaluate(Input_data)
+        self.record_scores(score, TCenter, Tnormal, valid)
+
+        return -score
+
+    # Map-like evaluation for DE (workers=...), scores a whole generation in the scorer pool when it is open
+    def map_population(self, func, population):
+
+        Input_data = np.array(list(population))
+
+        if self.scorerPool is None:
+            return self.calculateScoreBatch(Input_data.T)
+
+        score, TCenter, Tnormal, valid = self.scorerPool.evaluate(Input_data)
+        self.record_scores(score, TCenter, Tnormal, valid)
 
         return -score
 
@@ -744,37 +1062,31 @@ class makeSimulation():
         except:
             bounds = [(0, 1), (0, 1), (0, 1), (-1, 1), (-1, 1), (-1, 1)]
 
+        if self.scorer.space is not None:
+            bounds = self.scorer.space.bounds
+
         a = time.time()
 
-        ## while loop for poor initial values
-        while True:
-            result = differential_evolution(self.calculateScore, bounds)#, updating='deferred', workers=4)
-            check = l2n(self.gather_score)
-            if np.any(check != 0):
-                break
-            if self.restart > 20000:
-                print("There is no proper position for transducer, re-make ROI or sonication condition")
-                break
-            print("Poor initial values // Restart optimizer")
+        if self.optimizer == 'fft':
+            TCenter, Tnormal, score = self.correlation_search()
+            self.record_scores(l2n([score]), TCenter[None, :], Tnormal[None, :], l2n([True]))
+        else:
+            if self.multires_levels > 1:
+                result = self.multires_optimizer(bounds)
+            else:
+                result = self.run_optimizer(bounds)
+
+            TCenter, Tnormal = self.decode_placement(result.x)
+            TCenter = TCenter[0]
+            Tnormal = Tnormal[0]
 
         b = time.time()
         print("Computing time for optimizer: ", b-a)
+        print("Transducer templates: ", self.capCache.misses, " built, hit:", self.capCache.hits)
+        memo = self.scorer.memo
+        print("Score cache: hit:", memo.hits, " miss:", memo.misses, " hit rate: %.1f %%" % (100*memo.hit_rate()))
 
-        ROI_idx = self.ROI_idx
-        TCenter_normalized = result.x[:3]
-        TCenter = TCenter_normalized.copy()
-        Tnormal = result.x[3:]
-        Tnormal = l2n(Tnormal)/np.linalg.norm(l2n(Tnormal))
-
-        x_range = l2n([ROI_idx[:, 0].min(), ROI_idx[:, 0].max()])
-        y_range = l2n([ROI_idx[:, 1].min(), ROI_idx[:, 1].max()])
-        z_range = l2n([ROI_idx[:, 2].min(), ROI_idx[:, 2].max()])
-
-        TCenter[0] =  TCenter_normalized[0]*(x_range.max()- x_range.min()) + x_range.min()
-        TCenter[1] =  TCenter_normalized[1]*(y_range.max()- y_range.min()) + y_range.min()
-        TCenter[2] =  TCenter_normalized[2]*(z_range.max()- z_range.min()) + z_range.min()
-
-        optimalPos_idx = TCenter.astype(int)
+        optimalPos_idx = TCenter
         self.optimalPos_idx = optimalPos_idx
 
         optimalPos = self.skullCrop_itk.TransformIndexToPhysicalPoint((int(optimalPos_idx[0]), int(optimalPos_idx[1]), int(optimalPos_idx[2])))
@@ -784,12 +1096,105 @@ class makeSimulation():
         self.optialNormal = Tnormal
 
         point_normal_np = np.squeeze(l2n(self.gather_point))
-        np.save(self.path + "\\point_normal_conversion.npy", point_normal_np)
-        np.save(self.path + "\\point_normal_conversion.npy", point_normal_np)
-        np.savetxt(self.path + "\\point_normal_conversion.txt", point_normal_np, fmt='%.3f', delimiter=',')
+        np.save(os.path.join(self.path, "point_normal_conversion.npy"), point_normal_np)
+        np.save(os.path.join(self.path, "point_normal_conversion.npy"), point_normal_np)
+        np.savetxt(os.path.join(self.path, "point_normal_conversion.txt"), point_normal_np, fmt='%.3f', delimiter=',')
 
         print("Finish optimize !!")
 
+    # One optimizer run over bounds with the current scorer (DE with restarts or the surrogate), x0 seeds the
+    # DE population
+    def run_optimizer(self, bounds, popsize=15, maxiter=1000, x0=None, polish=True):
+
+        if self.workers > 1:
+            self.scorerPool = placementScorerPool(self.scorer, self.workers, self.worker_threads)
+            func = self.calculateScore
+            options = {'workers': self.map_population, 'updating': 'deferred'}
+        elif self.vectorized and DE_VECTORIZED:
+            func = self.calculateScoreBatch
+            options = {'vectorized': True, 'updating': 'deferred'}
+        elif self.vectorized:
+            func = self.calculateScore
+            options = {'workers': self.map_population, 'updating': 'deferred'}
+        else:
+            func = self.calculateScore
+            options = {}
+
+        if self.scorerPool is not None:
+            self.scorerPool.open()
+
+        try:
+            if self.optimizer == 'surrogate':
+                # Exact scores only for the candidates the surrogate proposes
+                init = self.initial_population(bounds, 64) if self.feasible_init else None
+                if isinstance(init, str):
+                    init = None
+                result = surrogateOptimizer(lambda X: self.map_population(None, X), bounds,
+                                            max_evals=self.surrogate_evals, init=init).minimize()
+                if not np.any(l2n(self.gather_score) != 0):
+                    print("Surrogate found no proper position, use search_space='scalp' or the DE optimizer")
+            else:
+                ## while loop for poor initial values
+                while True:
+                    if self.feasible_init:
+                        options['init'] = self.initial_population(bounds, popsize*len(bounds))
+                    if x0 is not None and isinstance(options.get('init'), np.ndarray):
+                        options['init'] = np.concatenate(([x0], options['init'][1:]))
+                    elif x0 is not None:
+                        options['x0'] = x0
+                    result = differential_evolution(func, bounds, popsize=popsize, maxiter=maxiter, polish=polish,
+                                                    **options)
+                    check = l2n(self.gather_score)
+                    if np.any(check != 0):
+                        break
+                    if self.restart > 20000:
+                        print("There is no proper position for transducer, re-make ROI or sonication condition")
+                        break
+                    print("Poor initial values // Restart optimizer")
+        except:
+            if self.scorerPool is not None:
+                self.scorerPool.close(terminate=True)
+                self.scorerPool = None
+            raise
+
+        if self.scorerPool is not None:
+            self.scorerPool.close()
+            self.scorerPool = None
+
+        return result
+
+    # Coarse-to-fine: optimise on block-averaged maps first, then refine around the optimum on the finer levels
+    def multires_optimizer(self, bounds):
+
+        fine = self.scorer
+        full = l2n(bounds).astype(float)
+        half = self.multires_shrink*(full[:, 1] - full[:, 0])
+        self.level_evaluations = []
+
+        try:
+            for level in range(self.multires_levels - 1, -1, -1):
+                self.level_factor = 2**level
+                self.scorer = fine if level == 0 else self.make_scorer(self.level_factor)
+
+                a = time.time()
+                restart = self.restart
+                if level == self.multires_levels - 1:
+                    result = self.run_optimizer(bounds)
+                else:
+                    # Small budget around the coarse optimum, no gradient polish on the voxelised score
+                    result = self.run_optimizer(bounds, self.multires_popsize, self.multires_maxiter, x0=result.x,
+                                                polish=False)
+                self.level_evaluations.append(self.restart - restart)
+                print("Level 1/%d: score %.3f, %d evaluations, %.1f s" % (self.level_factor, -result.fun,
+                                                                          self.level_evaluations[-1], time.time() - a))
+
+                bounds = list(zip(np.maximum(result.x - half, full[:, 0]), np.minimum(result.x + half, full[:, 1])))
+        finally:
+            self.scorer = fine
+            self.level_factor = 1
+
+        return result
+
     def set_trans_num(self):
         self.tran_num = 0
         self.cook = niiCook()
@@ -797,16 +1202,157 @@ class makeSimulation():
         self.gather_point = []
         self.gather_score = []
         self.restart = 0
+        self.get_cap_cache()
+
+        # ROI bounding ranges used to de-normalize the transducer centre
+        ROI_idx = self.ROI_idx
+        self.ROI_range = np.stack((ROI_idx.min(axis=0), ROI_idx.max(axis=0)), axis=1)
+
+        self.level_factor = 1
+        self.scorer = self.make_scorer()
+        self.scorerPool = None
+
+    # Placement scorer on the full maps, or for factor > 1 on maps block-reduced by factor (coarse search levels)
+    def make_scorer(self, factor=1):
+
+        if factor == 1:
+            FIELD, skull_arr, head, capCache = self.FIELD, self.skullCrop_arr, self.head, self.capCache
+        else:
+            FIELD = hlp.downsample_block(self.FIELD, factor, np.mean)
+            skull_arr = hlp.downsample_block(self.skullCrop_arr, factor, np.max)
+            head = hlp.downsample_block(self.head, factor, np.min, fill=1)
+            capCache = None
+
+        dx = self.dx*factor
+        target = l2n(self.back_source[0])//factor
+
+        space = None
+        if self.search_space == 'scalp':
+            space = self.make_scalp_space(skull_arr, head, target, dx)
+
+        return placementScorer(FIELD, skull_arr, self.ROI_range//factor, target, self.ROC, self.width, dx,
+                               normal_angle=self.normal_angle, capCache=capCache, prefilter=self.prefilter,
+                               space=space, memo_size=self.score_cache_size, head=head)
+
+    # Quasi-random (Sobol) DE population of placements that pass the angle check and the feasibility prefilter
+    def initial_population(self, bounds, size, rounds=16):
+
+        bounds = l2n(bounds).astype(float)
+        sobol = qmc.Sobol(bounds.shape[0])
+        n = 2**int(np.ceil(np.log2(size)))
+
+        tree = None
+        if self.scorer.space is None:
+            # ROI voxels (of the current level) that are not blocked (bone or inside the head) and lie in the box,
+            # which is narrowed around the previous optimum on the refinement levels. The rows decode as TCenter,
+            # which the scorer voxelises at TCenter[::-1], so that is the voxel checked
+            ROI_idx = np.unique(self.ROI_idx//self.level_factor, axis=0)
+            centres = ROI_idx[np.all(ROI_idx[:, ::-1] < l2n(self.scorer.context.shape), axis=1)]
+            centres = centres[~hlp.context_blocked(self.scorer.context, centres[:, ::-1])]
+            param = self.centre_parameters(centres)
+            centres = centres[np.all((param >= bounds[:3, 0]) & (param <= bounds[:3, 1]), axis=1)]
+
+            # Too few voxels would repeat the same centres, sample the box as it is instead
+            if centres.shape[0] >= size:
+                tree = cKDTree(centres)
+
+        population = []
+        for _ in range(rounds):
+            U = sobol.random(n)
+            if tree is not None:
+                X = self.sample_roi_placements(U, bounds, centres, tree)
+            else:
+                X = qmc.scale(U, bounds[:, 0], bounds[:, 1])
+
+            TCenter, Tnormal = self.scorer.decode(X)
+            population.append(X[self.scorer.feasible(TCenter, Tnormal)])
+
+            if sum(len(X) for X in population) >= size:
+                break
+
+        population = np.concatenate(population)[:size]
+        if population.shape[0] < 5:
+            print("Too few feasible placements for the initial population, use random initialization")
+            return 'latinhypercube'
+
+        return population
+
+    # Normalised box parameters of integer centres, decoding them gives the centres back
+    def centre_parameters(self, TCenter):
+
+        lo, hi = self.scorer.ROI_range[:, 0], self.scorer.ROI_range[:, 1]
+        return np.minimum((TCenter - lo + 0.5)/np.maximum(hi - lo, 1), 1)
+
+    # Box parameters for unit-cube samples: the sample is mapped into bounds and snapped to the nearest centre (ROI
+    # voxels inside bounds), the normal is drawn in the cone. Rows whose normal leaves bounds are dropped
+    def sample_roi_placements(self, U, bounds, centres, tree):
+
+        lo, hi = self.scorer.ROI_range[:, 0], self.scorer.ROI_range[:, 1]
+        box = qmc.scale(U[:, :3], bounds[:3, 0], bounds[:3, 1])
+
+        _, nearest = tree.query(lo + box*(hi - lo))
+        TCenter = centres[nearest]
+
+        to_target = self.scorer.target_idx[None, :] - TCenter
+        to_target = to_target/np.maximum(np.linalg.norm(to_target, axis=1), 1e-12)[:, None]
+
+        X = np.zeros((U.shape[0], bounds.shape[0]))
+        X[:, :3] = self.centre_parameters(TCenter)
+        X[:, 3:6] = cone_normals(to_target, U[:, 3], U[:, 4], self.normal_angle)
+
+        return X[np.all((X >= bounds[:, 0]) & (X <= bounds[:, 1]), axis=1)]
+
+    # Unit direction from the nearest skull voxel to the target (x, y, z index order)
+    def skull_direction(self, skull_arr, target):
+
+        bone = np.argwhere(skull_arr > 250)[:, ::-1]
+        nearest = bone[np.argmin(np.linalg.norm(bone - target, axis=1))]
+
+        return (target - nearest)/np.linalg.norm(target - nearest)
+
+    # Exhaustive search over every centre for a lattice of normals pointing inward around the skull direction
+    def correlation_search(self):
+
+        target = l2n(self.back_source[0]).astype(float)
+        normals = orientation_lattice(self.skull_direction(self.skullCrop_arr, target), self.fft_cone, self.fft_step)
+
+        engine = fftPlacementEngine(self.FIELD, self.skullCrop_arr, target, self.capCache,
+                                    normal_angle=self.normal_angle, workers=self.fft_workers)
+        best, best_index, normals = engine.run(normals)
+        engine.release()
+        print("FFT correlation: ", normals.shape[0], " orientations")
+
+        self.domainCook.makeITK(best, os.path.join(self.path, "FFT_score.nii"))
+        self.domainCook.makeITK(best_index, os.path.join(self.path, "FFT_orientation.nii"))
+        np.save(os.path.join(self.path, "FFT_normals.npy"), normals)
+
+        idx = np.unravel_index(np.argmax(best), best.shape)
+        TCenter = l2n(idx[::-1])
+
+        return TCenter, normals[best_index[idx]], float(best[idx])
+
+    # Search space on the scalp around the (first) target, polar axis toward the nearest skull voxel
+    def make_scalp_space(self, skull_arr, head, target, dx):
+
+        target = l2n(target).astype(float)
+
+        return scalpSearchSpace(head, target, -self.skull_direction(skull_arr, target), self.ROC, self.width, dx,
+                                normal_angle=self.normal_angle, cone=self.scalp_cone, standoff=self.scalp_standoff)
 
     # Final function to find optimal position
     def findOptimalPosition(self, source = l2n([-100,-100,-100]), cut_plane=False):
 
+        # Own copy, the sign flip below must not change the caller's array (or the default)
+        source = np.array(source, dtype=float)
 
         self.recording = True
         a = time.time()
 
         # if is ture the orientation of the transducer also going to be optimized
+        # The ROI sets the sensor mask of the back propagation runs
         if np.all(source==-100):
+            self.allocate_field(1)
+            self.make_ROI_mask(cut_plane)
             self.back_propagation_source()
             self.run_backpropagation()
             self.make_ROI(cut_plane)
@@ -814,21 +1360,23 @@ class makeSimulation():
         else:
             source[:, 0] = -source[:, 0]
             source[:, 1] = -source[:, 1]
+            self.allocate_field(source.shape[0])
+            self.make_ROI_mask()
 
-            for i in range(source.shape[0]):
-                point = self.skullCrop_itk.TransformPhysicalPointToIndex(source[i,:])
-                self.back_source.append(point)
-                self.p0 = np.zeros(self.domain_shape)
-                self.p0[int(point[0]), int(point[1]), int(point[2])] = 1
-                self.run_backpropagation()
-                self.make_ROI()
+            if self.bp_workers > 1:
+                self.parallel_backpropagation(source)
+            else:
+                for i in range(source.shape[0]):
+                    self.set_backpropagation_source(source[i,:])
+                    self.run_backpropagation()
+                    self.make_ROI()
 
-                del self.p_raw
+                    del self.BP_Phase, self.BP_Amp, self.BP_step
 
             self.Score_optimizer()
 
-            del self.PHASE
-            del self.AMP
+            self.FIELD = None
+            self.scorer = None
 
         b = time.time()
         print("Computing time whole process", b-a)
@@ -838,7 +1386,7 @@ class makeSimulation():
         final[0,:] = self.optimalPos
         final[1,:] = self.optialNormal
 
-        np.save(self.path+"\\optimal_position", final)
+        np.save(os.path.join(self.path, "optimal_position"), final)
 
         V1 = str('{:.3f}'.format(final[0,0]) + ' {:.3f}'.format(final[0,1]) + ' {:.3f}'.format(final[0,2]))
         f = open(os.path.join(self.path, 'Optimal position.txt'), 'w')
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The repository is used from its checkout, not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
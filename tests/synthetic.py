@@ -0,0 +1,104 @@
+import numpy as np
+
+l2n = lambda l: np.array(l)
+
+
+# Spherical head around the target: bone shell, scalp outside of it and an ROI shell beyond the scalp
+def make_case(shape=(48, 48, 48), n_targets=1, seed=0):
+
+    rng = np.random.default_rng(seed)
+    target = l2n(shape)//2
+
+    grid = np.indices(shape)
+    r = np.sqrt(((grid - target[:, None, None, None])**2).sum(axis=0))
+
+    skull = np.where((r > 8) & (r < 10), 1500.0, 0.0)
+    head = (r >= 11).astype(float)
+    ROI = ((r > 12) & (r < 22)).astype(float)
+
+    FIELD = np.zeros((n_targets,) + tuple(shape), dtype=np.complex64)
+    for i in range(n_targets):
+        phase = (0.8*r + rng.normal(0, 0.2, shape)) % (2*np.pi)
+        FIELD[i] = ROI*100*np.exp(-r/20)*np.exp(1j*phase)
+
+    ROI_idx = np.argwhere(ROI == 1)
+    ROI_range = np.stack((ROI_idx.min(axis=0), ROI_idx.max(axis=0)), axis=1)
+
+    return dict(FIELD=FIELD, skullCrop_arr=skull, head=head, ROI=ROI, ROI_idx=ROI_idx, ROI_range=ROI_range,
+                target_idx=target, ROC=30, width=20, dx=2e-3)
+
+
+def make_scorer(case, **kwargs):
+
+    from help_function.placement_scorer import placementScorer
+
+    return placementScorer(case['FIELD'], case['skullCrop_arr'], case['ROI_range'], case['target_idx'], case['ROC'],
+                           case['width'], case['dx'], head=case['head'], **kwargs)
+
+
+# Random box parameters, normals toward the target so most candidates pass the angle check
+def make_candidates(case, n, seed=1):
+
+    rng = np.random.default_rng(seed)
+    X = np.zeros((n, 6))
+    X[:, :3] = rng.random((n, 3))
+
+    lo, hi = case['ROI_range'][:, 0], case['ROI_range'][:, 1]
+    TCenter = (X[:, :3]*(hi - lo) + lo).astype(np.int64)
+    direction = case['target_idx'][None, :] - TCenter
+    X[:, 3:] = direction/np.maximum(np.linalg.norm(direction, axis=1), 1e-12)[:, None] + rng.normal(0, 0.1, (n, 3))
+
+    return X
+
+
+# makeSimulation holding the synthetic case as if preprocessing, make_ROI_mask and make_ROI had run
+def make_simulation(case, path):
+
+    import SimpleITK as sitk
+    from simulation_function import makeSimulation
+
+    simul = makeSimulation(path=str(path))
+    simul.ROC, simul.width, simul.dx = case['ROC'], case['width'], case['dx']
+    simul.grid_res = (case['dx'],)*3
+
+    shape = case['skullCrop_arr'].shape
+    image = sitk.Image(shape[2], shape[1], shape[0], sitk.sitkFloat32)
+    image.SetSpacing((case['dx']*1000,)*3)
+    simul.skullCrop_itk = image
+    simul.domain_shape = shape
+
+    simul.skullCrop_arr = case['skullCrop_arr']
+    simul.head = case['head']
+    simul.ROI = case['ROI']
+    simul.ROI_idx = case['ROI_idx']
+    simul.FIELD = case['FIELD']
+    simul.field_count = case['FIELD'].shape[0]
+    simul.back_source = [case['target_idx']]
+
+    return simul
+
+
+# RAW sensor series of a back propagation as the solver stores them: single cycle pulses arriving at every sensor
+# of case after the straight path from the target at speed c. Returns the makeSimulation fields read_BP needs
+def make_sensor_traces(case, n_sensors=500, steps=400, source_freq=2.5e5, samples_per_period=37.3, c=1500.0):
+
+    ROI = case['ROI']
+    sensor_idx = np.argwhere(ROI.transpose(2, 1, 0))[:, ::-1][:n_sensors]
+
+    period = 1/source_freq
+    dt = period/samples_per_period
+    times = (np.arange(steps) + 1)*dt
+
+    delay = np.linalg.norm(sensor_idx - case['target_idx'], axis=1)*case['dx']/c
+    x = times[:, None] - delay[None, :]
+    traces = np.where((x >= 0) & (x < period), np.sin(2*np.pi*x/period), 0).astype(np.float32)
+
+    return sensor_idx, traces, dt, source_freq
+
+
+def write_sensor_output(path, traces, start=0):
+
+    import h5py
+
+    with h5py.File(str(path), 'w') as file:
+        file['p'] = traces[start:][None, :, :]
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from help_function import help_function as hlp
+
+ROC, WIDTH, DX = 30, 20, 0.5e-3
+
+
+# Dense sampling of the cap surface (the rasterisation of the original make_transducer), (x, y, z) voxel units
+def sample_cap(Tnormal, n_height=300, n_angle=1200):
+
+    Rs = ROC/1000/DX
+    a = 0.5*WIDTH/1000/DX
+    H = Rs - np.sqrt(Rs**2 - a**2)
+
+    Vs = np.array([0, -Tnormal[2], Tnormal[1]])
+    if np.all(Vs == 0):
+        Vs = np.array([0, 1.0, 0])
+    Vs = Vs/np.linalg.norm(Vs)
+    Vt = np.cross(Tnormal, Vs)
+
+    depth = np.linspace(0, H, n_height)[:, None, None]
+    R = np.sqrt(np.maximum(Rs**2 - (Rs - H + depth)**2, 0))
+    theta = 2*np.pi*np.arange(n_angle)[None, :, None]/n_angle
+
+    return (-depth*Tnormal + R*(np.cos(theta)*Vs + np.sin(theta)*Vt)).reshape(-1, 3)
+
+
+@pytest.mark.parametrize('Tnormal', [(0, 0, 1), (1, 0, 0), (0.3, -0.5, 0.8), (-0.7, 0.7, 0.1)])
+def test_voxelise_cap_covers_the_cap_exactly(Tnormal):
+    Tnormal = np.array(Tnormal, dtype=float)/np.linalg.norm(Tnormal)
+    template = hlp.voxelise_cap(ROC, WIDTH, DX, Tnormal)
+    voxels = set(map(tuple, template.tolist()))
+
+    # Every voxel a cap point falls in is part of the template
+    sampled = set(map(tuple, np.round(sample_cap(Tnormal)).astype(int).tolist()))
+    assert sampled <= voxels
+
+    # and every template voxel cube reaches the sphere
+    Rs = ROC/1000/DX
+    H = Rs - np.sqrt(Rs**2 - (0.5*WIDTH/1000/DX)**2)
+    distance = np.linalg.norm(template - (Rs - H)*Tnormal, axis=1)
+    assert np.all(np.abs(distance - Rs) <= np.sqrt(3)/2 + 1e-9)
+    assert len(voxels) < 1.2*len(sampled)
+
+
+def test_lookup_many_packs_the_cached_templates():
+    cache = hlp.capTemplateCache(ROC, WIDTH, DX, maxsize=8)
+    rng = np.random.default_rng(0)
+    normals = rng.normal(0, 1, (12, 3))
+    normals[6:] = normals[:6]
+
+    ptr, offsets = cache.lookup_many(normals)
+
+    for c, Tnormal in enumerate(normals):
+        expected = hlp.make_cap_offsets(ROC, WIDTH, DX, cache.quantised_normal(cache.key(Tnormal)))
+        assert np.array_equal(offsets[ptr[c]:ptr[c + 1]], expected)
+    assert cache.misses == 6 and cache.hits == 6
+    assert len(cache.templates) == 6
@@ -0,0 +1,68 @@
+import numpy as np
+import SimpleITK as sitk
+
+from help_function import help_function as hlp
+from help_function.correlation_engine import fftPlacementEngine, orientation_lattice
+from help_function.niiCook import niiCook
+from synthetic import make_case, make_scorer, make_simulation
+
+
+def test_orientation_lattice_stays_in_the_cone():
+    axis = np.array([0.2, -0.4, 0.9])
+    normals = orientation_lattice(axis, 30, 10)
+
+    assert np.allclose(np.linalg.norm(normals, axis=1), 1)
+    cos_angle = normals @ (axis/np.linalg.norm(axis))
+    assert np.all(cos_angle >= np.cos(np.deg2rad(30)) - 1e-9)
+    assert np.isclose(cos_angle.max(), 1) and cos_angle.min() < np.cos(np.deg2rad(25))
+
+
+def test_fft_scores_match_the_scorer():
+    case = make_case()
+    scorer = make_scorer(case)
+    normals = orientation_lattice(case['target_idx'] - np.array([24, 24, 4]), 20, 10)
+
+    engine = fftPlacementEngine(case['FIELD'], case['skullCrop_arr'], case['target_idx'], scorer.capCache)
+    best, best_index, normals = engine.run(normals)
+
+    # Every centre with a score (and a sample of the rest) against the scorer at the winning orientation
+    rng = np.random.default_rng(0)
+    index = np.argwhere(best > 0)
+    index = np.concatenate((index, rng.integers(0, best.shape, (200, 3))))
+    TCenter = index[:, ::-1]
+    Tnormal = normals[np.maximum(best_index[tuple(index.T)], 0)]
+
+    ptr, offsets = scorer.capCache.lookup_many(Tnormal)
+    exact = hlp.score_context(scorer.context, TCenter, ptr, offsets)
+    exact[~scorer.check_angle(TCenter, Tnormal)] = 0
+
+    assert np.count_nonzero(best) > 100
+    assert np.allclose(best[tuple(index.T)], exact, rtol=1e-3, atol=1e-2)
+
+    # No orientation beats the best one anywhere
+    for Tnormal in normals[:4]:
+        assert np.all(engine.score_orientation(scorer.capCache.lookup(Tnormal), Tnormal) <= best)
+
+
+def test_correlation_search_writes_the_landscape(tmp_path):
+    case = make_case()
+    simul = make_simulation(case, tmp_path)
+    simul.fft_cone, simul.fft_step = 20, 10
+    simul.set_trans_num()
+    simul.domainCook = niiCook()
+    simul.domainCook.readITK(simul.skullCrop_itk)
+
+    TCenter, Tnormal, score = simul.correlation_search()
+
+    best = sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path/'FFT_score.nii')))
+    best_index = sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path/'FFT_orientation.nii')))
+    normals = np.load(str(tmp_path/'FFT_normals.npy'))
+
+    assert best.shape == case['skullCrop_arr'].shape
+    assert np.isclose(score, best.max())
+    assert np.array_equal(Tnormal, normals[best_index[tuple(TCenter[::-1])]])
+    assert np.all((best_index >= 0) == (best > 0))
+
+    # The global optimum is a placement the optimizer scores the same
+    X = np.concatenate((simul.centre_parameters(TCenter), Tnormal))[None, :]
+    assert np.isclose(simul.scorer.evaluate(X)[0][0], score, rtol=1e-3)
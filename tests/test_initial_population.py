@@ -0,0 +1,57 @@
+import numpy as np
+
+from help_function import help_function as hlp
+from synthetic import make_case, make_simulation
+
+
+def test_initial_population_on_non_cubic_grid(tmp_path):
+    simul = make_simulation(make_case(shape=(40, 48, 56)), tmp_path)
+    simul.set_trans_num()
+
+    bounds = [(0, 1), (0, 1), (0, 1), (-1, 1), (-1, 1), (-1, 1)]
+    population = simul.initial_population(bounds, 90)
+
+    assert isinstance(population, np.ndarray)
+    assert population.shape == (90, 6)
+
+    TCenter, Tnormal = simul.scorer.decode(population)
+    assert np.all(simul.scorer.feasible(TCenter, Tnormal))
+
+
+def test_initial_population_in_refinement_box(tmp_path):
+    simul = make_simulation(make_case(shape=(40, 48, 56)), tmp_path)
+    simul.set_trans_num()
+
+    # Narrowed box as multires_optimizer builds it around a feasible placement
+    full = np.array([(0, 1), (0, 1), (0, 1), (-1, 1), (-1, 1), (-1, 1)], dtype=float)
+    seed = simul.initial_population(full, 16)[0]
+    half = 0.1*(full[:, 1] - full[:, 0])
+    bounds = np.stack((np.maximum(seed - half, full[:, 0]), np.minimum(seed + half, full[:, 1])), axis=1)
+
+    population = simul.initial_population(bounds, 90)
+
+    assert population.shape == (90, 6)
+    assert np.all((population >= bounds[:, 0]) & (population <= bounds[:, 1]))
+    on_face = np.isclose(population, bounds[:, 0]) | np.isclose(population, bounds[:, 1])
+    assert on_face.mean() < 0.05
+    assert np.unique(population, axis=0).shape[0] == 90
+
+
+def test_initial_population_centres_are_unblocked_where_scored(tmp_path):
+    # Non-cubic grid with bone on one side only, so array order and (x, y, z) order block different voxels
+    case = make_case(shape=(40, 48, 56))
+    case['skullCrop_arr'][:, :, :16] = 1500.0
+    simul = make_simulation(case, tmp_path)
+    # Without the prefilter only the seeding itself keeps blocked centres out
+    simul.prefilter = False
+    simul.set_trans_num()
+
+    bounds = [(0, 1), (0, 1), (0, 1), (-1, 1), (-1, 1), (-1, 1)]
+    population = simul.initial_population(bounds, 90)
+    assert population.shape == (90, 6)
+
+    # The scorer voxelises TCenter (x, y, z) at array index TCenter[::-1]
+    TCenter, _ = simul.scorer.decode(population)
+    index = TCenter[:, ::-1]
+    assert np.all((index >= 0) & (index < np.array(case['skullCrop_arr'].shape)))
+    assert not np.any(hlp.context_blocked(simul.scorer.context, index))
@@ -0,0 +1,108 @@
+import os
+import sys
+import textwrap
+import time
+
+import pytest
+
+from kwave_function.kwave_bin_driver import KWaveBinaryDriver, KWaveRunError, KWaveTimeoutError
+from kwave_function.kwave_output_file import KWaveOutputFile
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason="stand-in solvers are POSIX scripts")
+
+# Stand-in solver: progress table rows, then exit with FAKE_EXIT after FAKE_SLEEP seconds
+SOLVER = textwrap.dedent('''
+    import os, sys, time
+    sleep = float(os.environ.get('FAKE_SLEEP', '0'))
+    print('+----------+----------------+--------------+--------------------+', flush=True)
+    for k in range(5):
+        time.sleep(sleep/5)
+        print('|    %3d%%  |  %10.3fs  |  %10.3fs  |  19/09/21 14:30:59 |' % (20*k, k, 5 - k), flush=True)
+    print('solver done', sys.argv[1:], flush=True)
+    sys.exit(int(os.environ.get('FAKE_EXIT', '0')))
+''')
+
+
+class inputFile():
+    file_name = 'in.h5'
+
+
+@pytest.fixture
+def solver(tmp_path):
+    path = tmp_path/'solver'
+    path.write_text('#!{}\n{}'.format(sys.executable, SOLVER))
+    path.chmod(0o755)
+    return str(path)
+
+
+def run(binary, monkeypatch, tmp_path, sleep=0, exit_code=0, **kwargs):
+    monkeypatch.setenv('FAKE_SLEEP', str(sleep))
+    monkeypatch.setenv('FAKE_EXIT', str(exit_code))
+    driver = KWaveBinaryDriver(start_sampling_time=5, binary_path=binary)
+    return driver.run_async(inputFile(), KWaveOutputFile(str(tmp_path/'out.h5')), **kwargs)
+
+
+def test_run_reports_progress_and_output_file(solver, monkeypatch, tmp_path):
+    events = []
+    future = run(solver, monkeypatch, tmp_path, progress=events.append)
+
+    output_file = future.result(timeout=60)
+
+    assert output_file.file_name == str(tmp_path/'out.h5')
+    assert output_file.start_sampling_time == 5
+    assert [event.percent for event in events] == [0, 20, 40, 60, 80]
+    assert future.progress == events[-1] and events[-1].eta == 1
+
+
+def test_non_zero_exit_raises(solver, monkeypatch, tmp_path):
+    with pytest.raises(KWaveRunError) as error:
+        run(solver, monkeypatch, tmp_path, exit_code=3).result(timeout=60)
+
+    assert error.value.return_code == 3
+    assert "-s', '6'" in error.value.output
+    assert isinstance(error.value, RuntimeError)
+
+
+def test_sync_run_raises(solver, monkeypatch, tmp_path):
+    monkeypatch.setenv('FAKE_EXIT', '2')
+    driver = KWaveBinaryDriver(binary_path=solver)
+
+    with pytest.raises(KWaveRunError):
+        driver.run(inputFile(), KWaveOutputFile(str(tmp_path/'out.h5')))
+
+
+def test_missing_binary_raises(tmp_path):
+    driver = KWaveBinaryDriver(binary_path=str(tmp_path/'missing'))
+
+    with pytest.raises(KWaveRunError):
+        driver.run_async(inputFile(), KWaveOutputFile(str(tmp_path/'out.h5'))).result(timeout=60)
+
+
+def test_timeout_kills_solver(solver, monkeypatch, tmp_path):
+    start = time.time()
+    with pytest.raises(KWaveTimeoutError):
+        run(solver, monkeypatch, tmp_path, sleep=30, timeout=0.5).result(timeout=60)
+
+    assert time.time() - start < 10
+
+
+def test_cancel_kills_solver(solver, monkeypatch, tmp_path):
+    future = run(solver, monkeypatch, tmp_path, sleep=30)
+    time.sleep(0.5)
+
+    assert future.cancel()
+    assert future.cancelled()
+    assert future.process.wait(timeout=10) != 0
+
+
+def test_timeout_kills_children_of_a_wrapper(solver, monkeypatch, tmp_path):
+    # The wrapper runs the solver as a child, which keeps the output pipe open after the wrapper is gone
+    wrapper = tmp_path/'wrapper'
+    wrapper.write_text('#!/bin/sh\n"{}" "$@"\n'.format(solver))
+    wrapper.chmod(0o755)
+
+    start = time.time()
+    with pytest.raises(KWaveTimeoutError):
+        run(str(wrapper), monkeypatch, tmp_path, sleep=30, timeout=0.5).result(timeout=60)
+
+    assert time.time() - start < 10
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from scipy.interpolate import interpn
+
+from kwave_function.kwave_data_filters import InterpDataFilter
+
+
+# The interpolation mesh path staggered used for every offset before
+def staggered_reference(data, offset):
+    grid = tuple(map(np.arange, data.shape))
+    mesh = np.stack(np.meshgrid(*(g + o for g, o in zip(grid, offset)), indexing='ij'), axis=-1)
+
+    staggered_data = interpn(grid, data, mesh, bounds_error=False, fill_value=float('nan'))
+    for i, o in enumerate(offset):
+        if o == 0:
+            continue
+        s = [slice(None)]*data.ndim
+        s[i] = slice(-1, None) if o > 0 else slice(0, 1)
+        staggered_data[tuple(s)] = data[tuple(s)]
+
+    return staggered_data
+
+
+@pytest.mark.parametrize('offset', [(0.5, 0, 0), (0, 0.5, 0), (0, 0, 0.5), (0, -0.5, 0), (0.25, 0, 0), (0, 0, -1),
+                                    (0, 0, 1), (0.3, 0, 0), (0, -0.7, 0)])
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_single_axis_staggered_matches_interpolation(offset, dtype):
+    data = np.random.default_rng(0).random((11, 8, 6)).astype(dtype)
+
+    staggered = InterpDataFilter.staggered(data, offset)
+    assert staggered.dtype == np.float64
+    assert np.array_equal(staggered, staggered_reference(data, offset))
+
+
+@pytest.mark.parametrize('offset', [0.3, -0.7])
+def test_single_axis_staggered_does_not_depend_on_slabs(offset):
+    data = np.random.default_rng(0).random((40, 5, 4))
+
+    whole = InterpDataFilter.staggered(data, (offset,))
+    slabs = InterpDataFilter._InterpDataFilter__staggered_axis(data, 0, offset, chunk_size=7*20)
+    assert np.array_equal(whole, slabs)
+
+
+def test_staggered_on_two_axes_still_interpolates():
+    data = np.random.default_rng(0).random((7, 6, 5))
+
+    assert np.allclose(InterpDataFilter.staggered(data, (0.5, 0.5, 0)), staggered_reference(data, (0.5, 0.5, 0)))
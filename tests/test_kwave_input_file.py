@@ -0,0 +1,79 @@
+import h5py
+import numpy as np
+import pytest
+
+from kwave_function.kwave_data_filters import InterpDataFilter
+from kwave_function.kwave_input_file import KWaveInputFile
+
+SHAPE = (12, 10, 9)
+MEDIUM = ('c0', 'rho0', 'rho0_sgx', 'rho0_sgy', 'rho0_sgz', 'BonA')
+
+
+def make_medium(seed=0):
+    rng = np.random.default_rng(seed)
+    return 1500 + 1000*rng.random(SHAPE), 1000 + 900*rng.random(SHAPE), 6 + 4*rng.random(SHAPE)
+
+
+def write_medium(path, c0, rho0, b_on_a, **kw):
+    with KWaveInputFile(str(path), SHAPE, 100, (1e-3,)*3, 1e-7, **kw) as input_file:
+        input_file.write_medium_sound_speed(c0)
+        input_file.write_medium_density(rho0)
+        input_file.write_medium_non_linear(b_on_a)
+
+    with h5py.File(str(path), 'r') as data:
+        return {name: data[name][()] for name in MEDIUM}
+
+
+def slabs(array, planes):
+    for start in range(0, array.shape[2], planes):
+        yield array[:, :, start:start + planes]
+
+
+def test_global_fields_are_in_kwave_order(tmp_path):
+    c0, rho0, b_on_a = make_medium()
+    written = write_medium(tmp_path/'input.h5', c0, rho0, b_on_a)
+
+    assert np.array_equal(written['c0'], c0.transpose(2, 1, 0).astype(np.float32))
+    assert np.array_equal(written['rho0'], rho0.transpose(2, 1, 0).astype(np.float32))
+    assert np.array_equal(written['BonA'], b_on_a.transpose(2, 1, 0).astype(np.float32))
+    for name, offset in (('rho0_sgx', (0.5, 0, 0)), ('rho0_sgy', (0, 0.5, 0)), ('rho0_sgz', (0, 0, 0.5))):
+        staggered = InterpDataFilter.staggered(rho0, offset)
+        assert np.array_equal(written[name], staggered.transpose(2, 1, 0).astype(np.float32))
+
+
+@pytest.mark.parametrize('slab_size', [1, 2*SHAPE[0]*SHAPE[1], 5*SHAPE[0]*SHAPE[1]])
+def test_slab_size_does_not_change_the_file(tmp_path, slab_size):
+    medium = make_medium()
+    reference = write_medium(tmp_path/'reference.h5', *medium, slab_size=1 << 20)
+    written = write_medium(tmp_path/'input.h5', *medium, slab_size=slab_size)
+
+    for name in MEDIUM:
+        assert written[name].tobytes() == reference[name].tobytes()
+
+
+@pytest.mark.parametrize('planes', [1, 4, SHAPE[2]])
+def test_slab_input_matches_array_input(tmp_path, planes):
+    c0, rho0, b_on_a = make_medium()
+    reference = write_medium(tmp_path/'reference.h5', c0, rho0, b_on_a)
+    written = write_medium(tmp_path/'input.h5', slabs(c0, planes), slabs(rho0, planes), slabs(b_on_a, planes))
+
+    for name in MEDIUM:
+        assert written[name].tobytes() == reference[name].tobytes()
+
+
+def test_chunked_compressed_file_has_same_data(tmp_path):
+    medium = make_medium()
+    reference = write_medium(tmp_path/'reference.h5', *medium)
+    written = write_medium(tmp_path/'input.h5', *medium, chunks=True, compression='gzip')
+
+    for name in MEDIUM:
+        assert written[name].tobytes() == reference[name].tobytes()
+
+
+def test_slabs_must_cover_the_domain(tmp_path):
+    c0, _, _ = make_medium()
+    with KWaveInputFile(str(tmp_path/'input.h5'), SHAPE, 100, (1e-3,)*3, 1e-7) as input_file:
+        with pytest.raises(ValueError):
+            input_file.write_global_field_slabs('c0', slabs(c0[:, :, :-1], 4))
+        with pytest.raises(ValueError):
+            input_file.write_global_field_slabs('c0', [c0[:-1]])
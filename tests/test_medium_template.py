@@ -0,0 +1,30 @@
+import numpy as np
+
+import simulation_function
+from synthetic import make_case, make_simulation
+
+
+def test_medium_template_hashes_the_domain_once(tmp_path, monkeypatch):
+    simul = make_simulation(make_case(), tmp_path)
+    simul.scratch_dir = str(tmp_path/'scratch')
+
+    hashed = []
+    key = simulation_function.runCache.key
+
+    def counting_key(*parts):
+        hashed.extend(part for part in parts if isinstance(part, np.ndarray))
+        return key(*parts)
+
+    monkeypatch.setattr(simulation_function.runCache, 'key', staticmethod(counting_key))
+
+    template = simul.get_medium_template(back=True)
+    assert simul.get_medium_template(back=True) is template
+    assert simul.get_medium_template(back=False) is not template
+    assert len(hashed) == 1
+
+    # A new domain gets a new template
+    skull = simul.skullCrop_arr.copy()
+    skull[0, 0, 0] = 2000
+    simul.skullCrop_arr = skull
+    assert simul.get_medium_template(back=True).key != template.key
+    assert len(hashed) == 2
@@ -0,0 +1,33 @@
+import time
+
+import numpy as np
+
+from synthetic import make_case, make_simulation
+
+BOUNDS = [(0, 1), (0, 1), (0, 1), (-1, 1), (-1, 1), (-1, 1)]
+
+
+def optimise(tmp_path, levels):
+    simul = make_simulation(make_case(), tmp_path)
+    simul.multires_levels = levels
+    simul.optimizer_check = 0
+    simul.set_trans_num()
+
+    np.random.seed(0)
+    a = time.time()
+    result = simul.multires_optimizer(BOUNDS) if levels > 1 else simul.run_optimizer(BOUNDS)
+
+    return simul, -result.fun, time.time() - a
+
+
+def test_refinement_level_runs_on_a_small_budget(tmp_path):
+    plain, plain_score, plain_time = optimise(tmp_path, 1)
+    multires, score, multires_time = optimise(tmp_path, 2)
+
+    # Full DE on the coarse maps only, the full resolution level is seeded with its optimum
+    coarse, fine = multires.level_evaluations
+    assert fine <= multires.multires_popsize*len(BOUNDS)*(multires.multires_maxiter + 1)
+    assert fine < plain.restart/3
+    assert multires_time < plain_time
+
+    assert score >= 0.95*plain_score
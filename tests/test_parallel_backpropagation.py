@@ -0,0 +1,75 @@
+import os
+import sys
+import textwrap
+import time
+
+import numpy as np
+import pytest
+
+from kwave_function.kwave_bin_driver import KWaveBinaryDriver, KWaveRunError
+from kwave_function.kwave_output_file import KWaveOutputFile
+from synthetic import make_case, make_simulation
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason="stand-in solvers are POSIX scripts")
+
+# Stand-in solver: the run of input 'fail' exits with an error, the others record their pid and hang
+SOLVER = textwrap.dedent('''
+    import os, sys, time
+    name = os.path.basename(sys.argv[sys.argv.index('-i') + 1])
+    if name == 'fail':
+        time.sleep(2)
+        sys.exit(3)
+    with open(os.path.join(os.environ['PID_DIR'], name), 'w') as file:
+        file.write(str(os.getpid()))
+    time.sleep(60)
+''')
+
+
+class inputFile():
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_failed_run_kills_the_other_solvers(tmp_path, monkeypatch):
+    solver = tmp_path/'solver'
+    solver.write_text('#!{}\n{}'.format(sys.executable, SOLVER))
+    solver.chmod(0o755)
+    pid_dir = tmp_path/'pids'
+    pid_dir.mkdir()
+    monkeypatch.setenv('PID_DIR', str(pid_dir))
+
+    simul = make_simulation(make_case(), tmp_path)
+    simul.scratch_dir = str(tmp_path/'scratch')
+    simul.bp_workers = 3
+    names = iter(['hang_0', 'fail', 'hang_1', 'never'])
+
+    def prepare(scratch, threads=None):
+        name = next(names)
+        driver = KWaveBinaryDriver(binary_path=str(solver))
+        return driver, inputFile(os.path.join(scratch, name)), KWaveOutputFile(os.path.join(scratch, 'out.h5')), None
+
+    monkeypatch.setattr(simul, 'prepare_backpropagation', prepare)
+
+    start = time.time()
+    with pytest.raises(KWaveRunError) as error:
+        simul.parallel_backpropagation(np.array([[2., 2, 2], [4, 4, 4], [6, 6, 6], [8, 8, 8]]))
+
+    assert error.value.return_code == 3
+    assert time.time() - start < 30
+    # Only bp_workers solvers were started, the fourth target never was
+    assert next(names) == 'never'
+    assert os.listdir(simul.scratch_dir) == []
+
+    pids = [int((pid_dir/name).read_text()) for name in ('hang_0', 'hang_1')]
+    deadline = time.time() + 10
+    while any(alive(pid) for pid in pids) and time.time() < deadline:
+        time.sleep(0.1)
+    assert not any(alive(pid) for pid in pids)
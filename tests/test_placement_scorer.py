@@ -0,0 +1,102 @@
+import subprocess
+import sys
+import textwrap
+
+import numpy as np
+
+from synthetic import make_case, make_scorer, make_candidates
+
+POOL_SCRIPT = textwrap.dedent('''
+    import sys
+    sys.path[:0] = {path!r}
+    import numpy as np
+    from synthetic import make_case, make_scorer, make_candidates
+    from help_function.placement_scorer import placementScorerPool
+
+    if __name__ == '__main__':
+        case = make_case()
+        scorer = make_scorer(case)
+        X = make_candidates(case, 64)
+        with placementScorerPool(scorer, processes=2) as pool:
+            score, _, _, valid = pool.evaluate(X)
+            assert np.array_equal(pool.evaluate(X)[0], score)
+        # Templates built and scores memoised by the workers are counted in the parent's caches
+        assert scorer.capCache.misses > 0 and len(scorer.capCache.templates) == 0
+        assert scorer.memo.hits + scorer.memo.misses == 2*np.count_nonzero(valid) and len(scorer.memo.scores) == 0
+        assert np.array_equal(score, scorer.evaluate(X)[0])
+        assert np.any(score > 0)
+        print('ok')
+''')
+
+
+def test_pool_matches_serial_and_exits(tmp_path):
+    script = tmp_path / 'pool.py'
+    script.write_text(POOL_SCRIPT.format(path=sys.path[:2]))
+
+    proc = subprocess.run([sys.executable, str(script)], capture_output=True, text=True, timeout=600)
+
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.strip().endswith('ok')
+
+
+def test_score_memo_is_kept_across_generations():
+    case = make_case()
+    scorer = make_scorer(case, memo_size=50)
+    X = make_candidates(case, 64)
+
+    score = scorer.evaluate(X)[0]
+    misses = scorer.memo.misses
+    assert 0 < misses <= 64 and len(scorer.memo.scores) == min(misses, 50)
+
+    # A converged generation repeats earlier placements, the last 50 are answered from the memo
+    assert np.array_equal(scorer.evaluate(X[-20:])[0], score[-20:])
+    assert scorer.memo.misses == misses
+    assert np.array_equal(make_scorer(case).evaluate(X)[0], score)
+
+
+def test_prefilter_only_rejects_zero_scores():
+    case = make_case(shape=(40, 48, 56))
+    X = make_candidates(case, 4000)
+
+    exact = make_scorer(case).evaluate(X)
+    filtered = make_scorer(case, prefilter=True).evaluate(X)
+
+    rejected = exact[3] & ~filtered[3]
+    assert np.any(rejected)
+    assert np.all(exact[0][rejected] == 0)
+    assert np.array_equal(filtered[0][filtered[3]], exact[0][filtered[3]])
+
+
+# Cap voxels gathered one placement at a time with numpy, the definition the packed kernels have to match
+def reference_score(case, scorer, TCenter, Tnormal):
+
+    offsets = scorer.capCache.lookup(Tnormal)
+    voxels = TCenter[::-1] + offsets
+    shape = np.array(case['skullCrop_arr'].shape)
+    if np.any(voxels < 0) or np.any(voxels >= shape):
+        return 0.0
+
+    index = tuple(voxels.T)
+    if np.any(case['skullCrop_arr'][index] > 250) or np.any(case['head'][index] == 0):
+        return 0.0
+
+    score = 0.0
+    for field in case['FIELD']:
+        values = field[index].astype(np.complex128)
+        if np.any(values == 0):
+            return 0.0
+        score += abs(values.sum())
+
+    return score
+
+
+def test_scorer_matches_reference():
+    case = make_case(shape=(40, 48, 56), n_targets=2)
+    scorer = make_scorer(case)
+    X = make_candidates(case, 400)
+
+    score, TCenter, Tnormal, valid = scorer.evaluate(X)
+    reference = [reference_score(case, scorer, TCenter[i], Tnormal[i]) if valid[i] else 0.0 for i in range(len(X))]
+
+    assert np.count_nonzero(score) > 10
+    assert np.allclose(score, reference, rtol=1e-4)
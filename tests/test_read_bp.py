@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from kwave_function.kwave_output_file import KWaveOutputFile
+from synthetic import make_case, make_sensor_traces, make_simulation, write_sensor_output
+
+
+def read_maps(simul, file_name, start=0):
+    file = KWaveOutputFile(file_name=str(file_name), start_sampling_time=start)
+    file.open()
+    try:
+        simul.read_BP(file)
+    finally:
+        file.close()
+    return simul.BP_Phase.copy(), simul.BP_Amp.copy(), simul.BP_step.copy()
+
+
+def make_bp_simulation(tmp_path, case, estimator):
+    sensor_idx, traces, dt, source_freq = make_sensor_traces(case)
+    simul = make_simulation(case, tmp_path)
+    simul.sensor_idx = sensor_idx
+    simul.dt = dt
+    simul.source_freq = source_freq
+    simul.phase_estimator = estimator
+    return simul, traces
+
+
+@pytest.mark.parametrize('estimator', ['peak', 'lockin'])
+def test_read_BP_does_not_depend_on_sensor_blocks(tmp_path, estimator):
+    case = make_case()
+    simul, traces = make_bp_simulation(tmp_path, case, estimator)
+    write_sensor_output(tmp_path / 'output.h5', traces)
+
+    simul.sensor_chunk = traces.shape[1]
+    whole = read_maps(simul, tmp_path / 'output.h5')
+    simul.sensor_chunk = 37
+    blocks = read_maps(simul, tmp_path / 'output.h5')
+
+    for a, b in zip(whole, blocks):
+        assert np.array_equal(a, b)
+    assert np.count_nonzero(whole[1]) == traces.shape[1]
+
+
+def test_lockin_phase_is_finer_than_the_time_step(tmp_path):
+    case = make_case()
+    errors = {}
+    for estimator in ('peak', 'lockin'):
+        simul, traces = make_bp_simulation(tmp_path, case, estimator)
+        write_sensor_output(tmp_path / 'output.h5', traces)
+        simul.sensor_chunk = 64
+        BP_Phase, _, _ = read_maps(simul, tmp_path / 'output.h5')
+
+        # Sine pulses leaving the target peak a quarter period after they reach the sensor
+        period = 1/simul.source_freq
+        delay = np.linalg.norm(simul.sensor_idx - case['target_idx'], axis=1)*case['dx']/1500.0
+        expected = 2*np.pi*(delay/period + 0.25)
+        phase = BP_Phase[tuple(simul.sensor_idx.T)]
+        errors[estimator] = np.max(np.abs(np.angle(np.exp(1j*(phase - expected)))))
+
+    # The peak estimator is bound to the time step, half a sample is pi/37.3 of a period
+    assert errors['lockin'] < 1e-2 < errors['peak'] <= np.pi/37.3 + 1e-6
+
+
+@pytest.mark.parametrize('estimator', ['peak', 'lockin'])
+def test_windowed_record_gives_the_full_record_maps(tmp_path, estimator):
+    case = make_case()
+    simul, traces = make_bp_simulation(tmp_path, case, estimator)
+    simul.sensor_chunk = 64
+    p0 = np.zeros(case['ROI'].shape)
+    p0[tuple(case['target_idx'])] = 1
+
+    first, last = simul.sampling_window(p0, 1500.0, 1500.0, simul.dt, traces.shape[0])
+    # Every pulse sample lies in the window, which skips the steps before the earliest arrival
+    active = np.flatnonzero(np.any(traces != 0, axis=1))
+    assert 0 < first <= active[0] and active[-1] < last <= traces.shape[0]
+
+    write_sensor_output(tmp_path / 'full.h5', traces)
+    write_sensor_output(tmp_path / 'window.h5', traces[:last], start=first)
+
+    file = KWaveOutputFile(file_name=str(tmp_path / 'window.h5'), start_sampling_time=first)
+    file.open()
+    try:
+        assert np.array_equal(file.read_sampling_time_steps(), np.arange(first, last))
+    finally:
+        file.close()
+
+    full = read_maps(simul, tmp_path / 'full.h5')
+    window = read_maps(simul, tmp_path / 'window.h5', start=first)
+    for a, b in zip(full, window):
+        assert np.allclose(a, b, rtol=0, atol=1e-9)
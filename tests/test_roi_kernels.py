@@ -0,0 +1,47 @@
+import numpy as np
+
+from help_function import help_function as hlp
+
+
+def make_block(n_sensors=300, nt=400, seed=0):
+    rng = np.random.default_rng(seed)
+    shape = (10, 12, 14)
+
+    flat = rng.choice(np.prod(shape), n_sensors, replace=False)
+    voxel_idx = np.stack(np.unravel_index(flat, shape), axis=1).astype(np.int64)
+    p_chunk = rng.normal(0, 1, (nt, n_sensors)).astype(np.float32)
+    times = np.arange(nt)*1e-7
+
+    return shape, voxel_idx, p_chunk, times
+
+
+def test_make_ROI_chunk_matches_peak_of_each_trace():
+    shape, voxel_idx, p_chunk, times = make_block()
+    period = 4e-6
+    BP_Phase, BP_Amp, BP_step = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+
+    hlp.make_ROI_chunk(voxel_idx, p_chunk, times, BP_Phase, BP_Amp, BP_step, period)
+
+    TOF = times[np.argmax(p_chunk, axis=0)]
+    index = tuple(voxel_idx.T)
+    assert np.allclose(BP_Amp[index], p_chunk.max(axis=0))
+    assert np.allclose(BP_step[index], np.floor(TOF/period))
+    assert np.allclose(BP_Phase[index], 2*np.pi*(TOF/period - np.floor(TOF/period)))
+
+
+def test_make_ROI_lockin_chunk_recovers_delay():
+    shape, voxel_idx, _, times = make_block()
+    period = 4e-6
+    delay = np.linspace(0, 0.9, voxel_idx.shape[0])*period
+    # Single cycle pulses of amplitude 2, like the back propagation source
+    x = times[:, None] - delay[None, :]
+    p_chunk = np.where((x >= 0) & (x < period), 2*np.sin(2*np.pi*x/period), 0)
+    BP_Phase, BP_Amp, BP_step = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+
+    hlp.make_ROI_lockin_chunk(voxel_idx, p_chunk, times, BP_Phase, BP_Amp, BP_step, period)
+
+    # A sine delayed by TOF peaks a quarter period after TOF
+    expected = (2*np.pi*(delay/period + 0.25)) % (2*np.pi)
+    error = np.angle(np.exp(1j*(BP_Phase[tuple(voxel_idx.T)] - expected)))
+    assert np.max(np.abs(error)) < 1e-2
+    assert np.allclose(BP_Amp[tuple(voxel_idx.T)], 2, rtol=1e-2)
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+
+from help_function.run_cache import runCache
+
+
+def age(cache, key, seconds):
+    stamp = os.path.getmtime(cache.entry(key)) - seconds
+    os.utime(cache.entry(key), (stamp, stamp))
+
+
+def test_key_depends_on_content_dtype_shape_and_order():
+    a = np.arange(12, dtype=np.float32).reshape(3, 4)
+
+    assert runCache.key(a, 1.5, 'bp') == runCache.key(a.copy(), 1.5, 'bp')
+    assert runCache.key(a) == runCache.key(np.asfortranarray(a))
+    assert runCache.key(a) != runCache.key(a.astype(np.float64))
+    assert runCache.key(a) != runCache.key(a.reshape(4, 3))
+    b = a.copy()
+    b[2, 3] += 1
+    assert runCache.key(a) != runCache.key(b)
+    assert runCache.key(1, 2) != runCache.key(2, 1)
+    assert runCache.key('ab', 'c') != runCache.key('a', 'bc')
+
+
+def test_store_and_lookup(tmp_path):
+    cache = runCache(str(tmp_path/'cache'))
+    key = runCache.key('run')
+    assert cache.lookup(key, 'output.h5') is None
+
+    source = tmp_path/'output.h5'
+    source.write_bytes(b'k-Wave output')
+    path = cache.store(key, 'output.h5', source=str(source))
+    assert not source.exists()
+    assert cache.lookup(key, 'output.h5') == path
+    with open(path, 'rb') as file:
+        assert file.read() == b'k-Wave output'
+
+    bp = np.random.default_rng(0).random((4, 5, 6))
+    path = cache.store(key, 'bp.npz', arrays={'bp': bp})
+    with np.load(cache.lookup(key, 'bp.npz')) as data:
+        assert np.array_equal(data['bp'], bp)
+
+    assert sorted(os.listdir(cache.entry(key))) == ['bp.npz', 'output.h5']
+
+
+def test_lookup_counts_as_use(tmp_path):
+    cache = runCache(str(tmp_path/'cache'))
+    key = runCache.key('run')
+    cache.store(key, 'bp.npz', arrays={'bp': np.zeros(3)})
+    age(cache, key, 3600)
+
+    before = os.path.getmtime(cache.entry(key))
+    cache.lookup(key, 'bp.npz')
+    assert os.path.getmtime(cache.entry(key)) > before
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = runCache(str(tmp_path/'cache'))
+    payload = {'data': np.zeros(1000)}
+
+    keys = [runCache.key(i) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.store(key, 'bp.npz', arrays=payload)
+        age(cache, key, 3600*(3 - i))
+    cache.lookup(keys[0], 'bp.npz')
+
+    entry_size = cache.size(keys[0])
+    cache.max_bytes = 3*entry_size
+    new = runCache.key(3)
+    cache.store(new, 'bp.npz', arrays=payload)
+
+    assert cache.lookup(keys[1], 'bp.npz') is None
+    for key in (keys[0], keys[2], new):
+        assert cache.lookup(key, 'bp.npz') is not None
+
+
+def test_new_entry_is_kept_even_if_larger_than_the_cache(tmp_path):
+    cache = runCache(str(tmp_path/'cache'), max_bytes=10)
+    old = runCache.key('old')
+    cache.store(old, 'bp.npz', arrays={'bp': np.zeros(100)})
+    age(cache, old, 3600)
+
+    new = runCache.key('new')
+    path = cache.store(new, 'bp.npz', arrays={'bp': np.zeros(100)})
+
+    assert os.path.isfile(path)
+    assert not os.path.exists(cache.entry(old))
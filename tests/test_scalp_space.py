@@ -0,0 +1,56 @@
+import numpy as np
+
+from synthetic import make_case, make_simulation
+
+BOX = [(0, 1), (0, 1), (0, 1), (-1, 1), (-1, 1), (-1, 1)]
+
+
+def make_scorer(tmp_path, search_space):
+    simul = make_simulation(make_case(), tmp_path)
+    simul.search_space = search_space
+    simul.set_trans_num()
+
+    return simul.scorer
+
+
+def sample(bounds, n, seed=0):
+    bounds = np.array(bounds, dtype=float)
+    return bounds[:, 0] + np.random.default_rng(seed).random((n, bounds.shape[0]))*(bounds[:, 1] - bounds[:, 0])
+
+
+def test_scalp_space_samples_are_nearly_all_feasible(tmp_path):
+    scalp = make_scorer(tmp_path, 'scalp')
+    box = make_scorer(tmp_path, 'box')
+    assert len(scalp.space.bounds) == 5
+
+    scalp_score, TCenter, Tnormal, scalp_valid = scalp.evaluate(sample(scalp.space.bounds, 2000))
+    box_score, _, _, box_valid = box.evaluate(sample(BOX, 2000))
+
+    # The angle check holds by construction, placements sit outside the head
+    assert np.all(scalp.check_angle(TCenter, Tnormal))
+    assert scalp_valid.mean() > 0.9
+    assert np.count_nonzero(scalp_score) > 4*np.count_nonzero(box_score)
+
+
+def test_scalp_parameters_move_the_placement(tmp_path):
+    space = make_scorer(tmp_path, 'scalp').space
+    X = np.tile([0.3, 0.6, 0.0, 0.0, 0.0], (5, 1))
+
+    # The gap moves the bowl away from the target along the same ray
+    X[:, 2] = np.linspace(0, 1, 5)
+    TCenter, Tnormal = space.decode(X)
+    distance = np.linalg.norm(TCenter - space.target_idx, axis=1)
+    assert np.all(np.diff(distance) >= 0)
+    assert distance[-1] - distance[0] > 0.8*(space.standoff[1] - space.standoff[0])
+
+    # Without tilt the normal points at the target, a full tilt reaches normal_angle
+    to_target = space.target_idx - TCenter
+    to_target /= np.linalg.norm(to_target, axis=1)[:, None]
+    assert np.allclose(np.sum(Tnormal*to_target, axis=1), 1)
+
+    X[:, 3] = 1
+    TCenter, Tnormal = space.decode(X)
+    to_target = space.target_idx - TCenter
+    to_target /= np.linalg.norm(to_target, axis=1)[:, None]
+    angle = np.rad2deg(np.arccos(np.clip(np.sum(Tnormal*to_target, axis=1), -1, 1)))
+    assert np.allclose(angle, space.normal_angle, atol=1e-3)
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from simulation_function import makeSimulation
+
+
+def test_make_scratch_gives_unique_directories_under_scratch_dir(tmp_path):
+    simul = makeSimulation(path=str(tmp_path))
+    simul.scratch_dir = str(tmp_path / 'scratch')
+
+    first = simul.make_scratch()
+    second = simul.make_scratch()
+
+    assert first != second
+    for scratch in (first, second):
+        assert os.path.isdir(scratch)
+        assert os.path.dirname(scratch) == simul.scratch_dir
+
+
+@pytest.mark.parametrize('keep', [False, True])
+def test_clean_scratch_honours_keep_scratch(tmp_path, keep):
+    simul = makeSimulation(path=str(tmp_path))
+    simul.scratch_dir = str(tmp_path / 'scratch')
+    simul.keep_scratch = keep
+
+    scratch = simul.make_scratch()
+    open(os.path.join(scratch, 'kwave_out.h5'), 'w').close()
+    simul.clean_scratch(scratch)
+
+    assert os.path.isdir(scratch) == keep
+
+
+@pytest.mark.parametrize('run', ['run_simulation', 'run_backpropagation'])
+def test_failed_run_removes_its_scratch(tmp_path, monkeypatch, run):
+    simul = makeSimulation(path=str(tmp_path))
+    simul.scratch_dir = str(tmp_path / 'scratch')
+    used = []
+
+    def fail(scratch):
+        used.append(scratch)
+        open(os.path.join(scratch, 'kwave_in.h5'), 'w').close()
+        raise RuntimeError('solver failed')
+
+    monkeypatch.setattr(simul, '_makeSimulation__' + run, fail)
+    with pytest.raises(RuntimeError):
+        getattr(simul, run)()
+
+    assert len(used) == 1 and not os.path.exists(used[0])
+    assert os.listdir(simul.scratch_dir) == []
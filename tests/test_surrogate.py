@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from scipy.optimize import differential_evolution
+
+from help_function.surrogate import gaussianProcess, surrogateOptimizer
+from synthetic import make_case, make_simulation
+
+
+@pytest.fixture(scope='module')
+def scalp_scorer(tmp_path_factory):
+    simul = make_simulation(make_case(), tmp_path_factory.mktemp('surrogate'))
+    simul.search_space = 'scalp'
+    simul.set_trans_num()
+
+    return simul.scorer
+
+
+def objective(scorer):
+    return lambda X: -scorer.evaluate(X)[0]
+
+
+def test_surrogate_matches_de_within_tolerance(scalp_scorer):
+    bounds = scalp_scorer.space.bounds
+    func = objective(scalp_scorer)
+
+    reference = differential_evolution(lambda x: None, bounds, workers=lambda _, X: func(np.array(list(X))),
+                                       updating='deferred', seed=0)
+
+    # Tolerance of the surrogateOptimizer docstring: every run within 6 %, the median within 2 %
+    scores = []
+    for seed in range(3):
+        result = surrogateOptimizer(func, bounds, seed=seed).minimize()
+        assert result.nfev <= 1000 < reference.nfev
+        scores.append(result.fun/reference.fun)
+
+    assert min(scores) >= 0.94
+    assert np.median(scores) >= 0.98
+
+
+def test_fit_falls_back_when_no_kernel_factorises():
+    X = np.random.default_rng(0).random((20, 2))
+    y = X.sum(axis=1)
+
+    gp = gaussianProcess().fit(X, y)
+    mu, _ = gp.predict(X)
+    assert np.allclose(mu, y, atol=1e-2)
+
+    # Nothing factorises (a negative jitter makes every kernel matrix indefinite): the previous model is kept, a
+    # first fit raises
+    gp.jitter = (-1e9,)
+    assert gp.fit(X[:10], y[:10]) is gp
+    assert np.array_equal(gp.predict(X)[0], mu)
+    with pytest.raises(np.linalg.LinAlgError):
+        gaussianProcess(jitter=(-1e9,)).fit(X, y)
+
+    # A larger jitter is tried before giving up
+    gp = gaussianProcess(jitter=(-1e9, 1)).fit(X, y)
+    assert np.allclose(gp.predict(X)[0], mu)